@@ -0,0 +1,119 @@
+"""
+Consumer-side lag tracing for ``metadata_enqueue`` messages.
+
+Every message carries, in its ``trace``, the time the request reached the
+proxy and the time it was enqueued; the publish time is sent in the
+``x-enqueue-published-at`` header. ``LagTracker`` adds the consumer times
+and keeps a histogram per stage:
+
+ * proxy: request arrival to enqueue (classification, serialization)
+ * buffer: enqueue to publish, waiting in the proxy buffer
+ * broker: publish to consumer, waiting in the queue
+ * processing: consumer processing
+ * total: request arrival to end of processing
+
+Usage with a pika consumer:
+
+    tracker = LagTracker()
+
+    def callback(channel, method, properties, body):
+        trace = tracker.received(properties, body)
+        index(body)
+        tracker.processed(trace)
+        channel.basic_ack(method.delivery_tag)
+
+    ...
+    print(tracker.report())
+
+Stages that cross hosts (broker, total) depend on clocks being in sync.
+"""
+import json
+import time
+
+from metadata_enqueue.stats import Histogram
+
+# AMQP header with the high-resolution publish time, as a string since
+# AMQP tables have no portable float type
+PUBLISHED_AT_HEADER = 'x-enqueue-published-at'
+
+STAGES = ('proxy', 'buffer', 'broker', 'processing', 'total')
+
+
+class Trace(object):
+    """ Stage times of one message, in seconds since the epoch """
+
+    __slots__ = ('trans_id', 'request_ts', 'enqueue_ts', 'publish_ts',
+                 'received_ts')
+
+    def __init__(self, trans_id=None, request_ts=None, enqueue_ts=None,
+                 publish_ts=None, received_ts=None):
+        self.trans_id = trans_id
+        self.request_ts = request_ts
+        self.enqueue_ts = enqueue_ts
+        self.publish_ts = publish_ts
+        self.received_ts = received_ts
+
+
+def parse_trace(properties, body, received_ts=None):
+    """
+    Builds a ``Trace`` from a consumed message.
+
+    :param properties: pika.BasicProperties of the message
+    :param body: message body, serialized or already loaded
+    :param received_ts: consumer receive time; defaults to now
+    """
+    if not isinstance(body, dict):
+        if isinstance(body, bytes):
+            body = body.decode('utf-8')
+        body = json.loads(body)
+
+    trace = body.get('trace') or {}
+    headers = getattr(properties, 'headers', None) or {}
+
+    publish_ts = headers.get(PUBLISHED_AT_HEADER)
+    if publish_ts is not None:
+        publish_ts = float(publish_ts)
+
+    return Trace(
+        trans_id=trace.get('trans_id') or
+        getattr(properties, 'correlation_id', None),
+        request_ts=trace.get('request_ts'),
+        enqueue_ts=trace.get('enqueue_ts'),
+        publish_ts=publish_ts,
+        received_ts=received_ts or time.time())
+
+
+class LagTracker(object):
+    """ Keeps a latency histogram per stage of the consumed messages """
+
+    def __init__(self):
+        self.histograms = dict((stage, Histogram()) for stage in STAGES)
+
+    def received(self, properties, body, now=None):
+        """ Call when a message is consumed. Returns its ``Trace`` """
+        return parse_trace(properties, body, now)
+
+    def processed(self, trace, now=None):
+        """ Call when the message processing ends """
+        now = now or time.time()
+
+        stages = (
+            ('proxy', trace.request_ts, trace.enqueue_ts),
+            ('buffer', trace.enqueue_ts, trace.publish_ts),
+            ('broker', trace.publish_ts, trace.received_ts),
+            ('processing', trace.received_ts, now),
+            ('total', trace.request_ts, now),
+        )
+
+        for stage, start, end in stages:
+            if start is not None and end is not None:
+                self.histograms[stage].record(end - start)
+
+    def report(self):
+        """ Returns the percentiles of every stage, in microseconds """
+        return dict((stage, histogram.to_dict())
+                    for stage, histogram in self.histograms.items())
+
+    def reset(self):
+        for histogram in self.histograms.values():
+            histogram.reset()
@@ -10,6 +10,12 @@ will be done if ``x-(account|container)-meta-enqueue`` is not set.
 ``metadata_enqueue`` exports all meta headers (x-object-meta-),
 content-type and content-length headers.
 
+Account and container events may be enabled with ``account_events`` and
+``container_events``. They are published for accounts and containers with
+the ``enqueue`` flag set and whenever a request sets or removes the flag,
+exporting the account or container meta headers. Messages carry a ``type``
+key: ``account``, ``container`` or ``object``.
+
 The ``metadata_enqueue`` middleware should be added to the pipeline in
 your ``/etc/swift/proxy-server.conf`` file just after any auth middleware.
 For example:
@@ -25,6 +31,69 @@ For example:
     queue_port
     queue_vhost
     queue_name
+    # Admin path exposing latency histograms (reseller admins only)
+    stats_path = /enqueue/stats
+    # Profile one in N PUT/POST/DELETE requests (0 disables it)
+    profile_sample_rate = 0
+    profile_dump_path
+    # Publish account and container PUT/POST/DELETE events
+    container_events = false
+    account_events = false
+    # Events left in memory on shutdown are spooled here
+    spool_dir
+    spool_replay_interval = 60
+    # Defaults to publish_timeout, if greater than 5
+    shutdown_timeout = 5
+    handle_signals = true
+    # Broker topology (see ``metadata_enqueue.topology``)
+    exchange
+    exchange_type = direct
+    queue_mode = lazy
+    queue_max_length
+    queue_overflow
+    queue_message_ttl
+    queue_dead_letter_exchange
+
+Events are buffered in memory and published by a background greenthread, so
+requests are never delayed by the queue. Events may be split by HTTP method
+in priority lanes (see ``metadata_enqueue.publisher``), so DELETE events
+overtake a backlog of uploads:
+
+    lane_mode = queue
+    lanes = delete, metadata
+    lane_delete_methods = DELETE
+    lane_delete_priority = 9
+    lane_metadata_methods = PUT POST
+    lane_metadata_priority = 1
+
+The publisher runs a pool of greenthreads, each one owning a channel and
+writing up to ``publish_window`` messages back to back. The pool follows
+the buffer depth up to ``publisher_max_workers``.
+
+On SIGTERM, SIGHUP or interpreter exit, pending events are flushed within
+``shutdown_timeout`` seconds and the remaining ones are written to
+``spool_dir``. The publisher scans ``spool_dir`` every
+``spool_replay_interval`` seconds and publishes spooled events again.
+
+Events may be fanned out to several sinks besides the broker, such as an
+append-only log file, a UNIX socket or a second broker (see
+``metadata_enqueue.sinks``):
+
+    sinks = amqp, audit
+    sink_audit_type = file
+    sink_audit_path = /var/log/swift/enqueue.log
+
+Every message carries a ``trace`` with the transaction id and the times the
+request arrived and the message was enqueued; it is published with the
+transaction id as ``correlation_id`` and the publish time in the
+``x-enqueue-published-at`` header. ``metadata_enqueue.lag.LagTracker``
+computes the lag of each stage on the consumer side.
+
+Latency histograms (classification, info lookup, serialization, publish
+time and buffer wait) are served as JSON by ``GET <stats_path>``.
+``GET <stats_path>?profile`` returns the aggregated profiler report,
+``POST <stats_path>?profile_sample_rate=N`` changes the sampling rate at
+runtime and ``DELETE <stats_path>`` resets everything.
 
 To enable the metadata enqueue on an account level:
 
@@ -38,28 +107,80 @@ Remove the metadata enqueue:
 
     swift post -m enqueue:
 
+To publish only some objects of a container, set enqueue rules on it (see
+``metadata_enqueue.rules``):
+
+    swift post container -m "enqueue-names:images/*,*.jpg"
+    swift post container -m "enqueue-content-types:image/*"
+    swift post container -m "enqueue-methods:PUT,DELETE"
+
 To create an object with indexable metadata:
     swift upload <container> <file> -H "x-object-meta-example:content"
 """
+import atexit
+import collections
+import os
 import pika
 import json
+import mimetypes
+import signal
+import time
+
+import eventlet
 
 from datetime import datetime
 from swift.common import swob, utils
+from swift.common.constraints import valid_api_version
 from swift.proxy.controllers.base import get_account_info, get_container_info
 
+from metadata_enqueue.publisher import DEFAULT_PUBLISH_TIMEOUT, Event, \
+    Publisher, parse_lanes, queue_declarations
+from metadata_enqueue.rules import RulesCache
+from metadata_enqueue.sinks import SINK_AMQP, load_sink, parse_sinks
+from metadata_enqueue.spool import Spool
+from metadata_enqueue.stats import Histogram, SamplingProfiler
+from metadata_enqueue.topology import Topology
+
 META_ENQUEUE_ENABLED = 'enqueue'
 META_OBJECT_PREFIX = 'x-object-meta'
 
+LEVEL_ACCOUNT = 'account'
+LEVEL_CONTAINER = 'container'
+LEVEL_OBJECT = 'object'
+
+# Meta headers exported for account and container events
+META_PREFIXES = {
+    LEVEL_ACCOUNT: ('x-account-meta-', 'x-remove-account-meta-'),
+    LEVEL_CONTAINER: ('x-container-meta-', 'x-remove-container-meta-'),
+}
+
 # Object headers allowed to be indexed
 ALLOWED_HEADERS = ['content-type', 'content-length']
 ALLOWED_METHODS = ('PUT', 'POST', 'DELETE')
 
+DEFAULT_STATS_PATH = '/enqueue/stats'
+DEFAULT_SHUTDOWN_TIMEOUT = 5.0
+
+# Signals that make the worker exit or reload
+SHUTDOWN_SIGNALS = (signal.SIGTERM, signal.SIGHUP)
+
+# Latency histograms kept in-process and exposed at ``stats_path``.
+# ``publish`` measures a whole pipelined batch; ``buffer_wait`` the time
+# each event waits in the buffer before being published.
+HISTOGRAMS = ('classification', 'info', 'serialization', 'publish',
+              'buffer_wait')
 
-def start_channel_conn(conf, logger):
+# Environ key with the time the request reached the middleware
+ENV_ARRIVAL = 'metadata_enqueue.arrival'
+
+
+def start_channel_conn(conf, logger, topology=None):
     """
-    If there's a queue channel started, return it immediately.
-    Otherwise, trys to connect to the queue, create and returns the channel.
+    Trys to connect to the queue, declare the topology and returns the
+    channel.
+
+    :param topology: ``Topology`` to declare. Defaults to ``queue_name``
+                     with the queue arguments set in ``conf``.
 
     :returns: pika.adapters.blocking_connection.BlockingChannel if success;
               None otherwise.
@@ -84,12 +205,20 @@ def start_channel_conn(conf, logger):
 
     try:
         channel = connection.channel()
-        channel.queue_declare(queue=conf.get('queue_name'), durable=True)
+        topology = topology or Topology(conf, [(conf.get('queue_name'), None)])
+        topology.declare(channel)
         logger.debug('Enqueue: Queue Channel OK')
     except (pika.exceptions.ConnectionClosed, Exception):
         logger.exception('Enqueue: Fail to create channel')
         channel = None
 
+        # Do not leak a connection on every retry (e.g. PRECONDITION_FAILED
+        # after changing the arguments of an existing queue)
+        try:
+            connection.close()
+        except Exception:
+            pass
+
     return channel
 
 
@@ -104,36 +233,222 @@ class Enqueue(object):
 
         self.app = app
         self.conf = conf
-        self.channel = None
+
+        self.stats_path = conf.get('stats_path', DEFAULT_STATS_PATH)
+        self.histograms = dict((name, Histogram()) for name in HISTOGRAMS)
+        self.profiler = SamplingProfiler(
+            int(conf.get('profile_sample_rate', 0)),
+            conf.get('profile_dump_path'))
+
+        self.levels = set([LEVEL_OBJECT])
+        if utils.config_true_value(conf.get('container_events')):
+            self.levels.add(LEVEL_CONTAINER)
+        if utils.config_true_value(conf.get('account_events')):
+            self.levels.add(LEVEL_ACCOUNT)
+
+        self.rules_cache = RulesCache(
+            int(conf.get('rules_cache_size', RulesCache().size)))
+
+        # Gives a batch being published the chance to finish
+        self.shutdown_timeout = float(conf.get('shutdown_timeout', max(
+            DEFAULT_SHUTDOWN_TIMEOUT,
+            float(conf.get('publish_timeout', DEFAULT_PUBLISH_TIMEOUT)))))
+        self.handle_signals = utils.config_true_value(
+            conf.get('handle_signals', True))
+        self._hooks_installed = False
+        self._previous_handlers = {}
+
+        # The first broker sink is the ``publisher``, recording the publish
+        # and buffer_wait histograms
+        self.sinks = collections.OrderedDict()
+        self.publisher = None
+        spool_dirs = set()
+
+        for name, sink_type, sink_conf in parse_sinks(conf):
+            if sink_type != SINK_AMQP:
+                self.sinks[name] = load_sink(sink_type)(
+                    name, sink_conf, self.logger)
+                continue
+
+            spool_dir = sink_conf.get('spool_dir')
+            if spool_dir in spool_dirs:
+                raise ValueError('Sink %s: spool_dir %s already in use' %
+                                 (name, spool_dir))
+            if spool_dir:
+                spool_dirs.add(spool_dir)
+
+            publisher = self._make_publisher(sink_conf, self.publisher is None)
+            self.sinks[name] = publisher
+            self.publisher = self.publisher or publisher
+
+    def _make_publisher(self, conf, histograms=False):
+        """ Builds a ``Publisher`` for the broker set in ``conf`` """
+        spool_dir = conf.get('spool_dir')
+        spool = Spool(spool_dir, self.logger) if spool_dir else None
+
+        lanes = parse_lanes(conf, ALLOWED_METHODS)
+        topology = Topology(conf, queue_declarations(conf, lanes))
+
+        def connect():
+            return start_channel_conn(conf, self.logger, topology)
+
+        histogram = buffer_histogram = None
+        if histograms:
+            histogram = self.histograms['publish']
+            buffer_histogram = self.histograms['buffer_wait']
+
+        return Publisher(conf, self.logger, lanes, connect,
+                         histogram=histogram,
+                         buffer_histogram=buffer_histogram,
+                         topology=topology, spool=spool)
 
     @swob.wsgify
     def __call__(self, req):
+        req.environ.setdefault(ENV_ARRIVAL, time.time())
 
-        # If this request is not suitable for indexing, return immediately
-        if not self.is_suitable_for_indexing(req):
-            return self.app
-
-        # If channel is None, start connection
-        self.channel = self.channel or\
-            start_channel_conn(self.conf, self.logger)
+        if self.stats_path and req.path == self.stats_path:
+            return self.handle_stats(req)
 
-        if self.channel:
-            self.send_req_to_queue(self.channel, req)
+        if self._is_valid_method(req) and self.profiler.should_sample():
+            self.profiler.run(self.handle_event, req)
         else:
-            self.logger.error(
-                'Enqueue: Fail to connect to queue, skiping %s %s' %
-                (req.method, req.path_info))
+            self.handle_event(req)
 
         return self.app
 
+    def handle_event(self, req):
+        """ Classifies the request and enqueues it, if suitable """
+        with self.histograms['classification'].time():
+            suitable = self.is_suitable_for_indexing(req)
+
+        if suitable:
+            self.send_req_to_queue(req)
+
+    def shutdown(self, timeout=None):
+        """
+        Flushes the pending events of every sink, concurrently, within
+        ``timeout`` seconds (defaults to ``shutdown_timeout``) and spills
+        whatever remains to the spool.
+        """
+        if timeout is None:
+            timeout = self.shutdown_timeout
+
+        pool = eventlet.GreenPool(len(self.sinks))
+        flushes = [(sink, pool.spawn(sink.flush, timeout))
+                   for sink in self.sinks.values()]
+
+        for sink, flush in flushes:
+            if flush.wait():
+                continue
+
+            spilled = sink.spill()
+            if spilled:
+                self.logger.info('Enqueue: %d events spooled on shutdown',
+                                 spilled)
+
+    def _install_hooks(self):
+        """
+        Registers ``shutdown`` to run at interpreter exit and on
+        ``SHUTDOWN_SIGNALS``. Installed on the first event, so the handlers
+        set by the server for its workers are already in place and are
+        called after the flush.
+        """
+        if self._hooks_installed:
+            return
+
+        self._hooks_installed = True
+        atexit.register(self.shutdown)
+
+        if not self.handle_signals:
+            return
+
+        for signum in SHUTDOWN_SIGNALS:
+            try:
+                self._previous_handlers[signum] = signal.signal(
+                    signum, self._on_signal)
+            except ValueError:
+                # Not running in the main thread
+                self.logger.warning(
+                    'Enqueue: Fail to handle signal %d', signum)
+
+    def _on_signal(self, signum, frame):
+        # A signal handler must not block the hub: flush in a greenthread
+        eventlet.spawn_n(self._shutdown_and_chain, signum, frame)
+
+    def _shutdown_and_chain(self, signum, frame):
+        self.shutdown()
+
+        previous = self._previous_handlers.get(signum, signal.SIG_DFL)
+        if previous == signal.SIG_DFL:
+            signal.signal(signum, signal.SIG_DFL)
+            os.kill(os.getpid(), signum)
+        elif callable(previous):
+            previous(signum, frame)
+
+    def handle_stats(self, req):
+        """
+        Serves the in-process statistics. Only reseller admins are allowed.
+
+         * GET: latency histograms as JSON; profiler report if ``?profile``
+         * POST: set ``?profile_sample_rate=N``
+         * DELETE: reset histograms and profiler
+        """
+        if not req.environ.get('reseller_request'):
+            return swob.HTTPForbidden(request=req)
+
+        if req.method == 'GET':
+            if 'profile' in req.params:
+                self.profiler.dump()
+                return swob.Response(
+                    request=req,
+                    body=self.profiler.report().encode('utf-8'),
+                    content_type='text/plain')
+
+            return swob.Response(
+                request=req,
+                body=json.dumps(self.get_stats()).encode('utf-8'),
+                content_type='application/json')
+
+        if req.method == 'POST':
+            try:
+                rate = int(req.params['profile_sample_rate'])
+            except (KeyError, ValueError):
+                return swob.HTTPBadRequest(
+                    request=req, body=b'Invalid profile_sample_rate')
+
+            self.profiler.sample_rate = max(rate, 0)
+            return swob.HTTPNoContent(request=req)
+
+        if req.method == 'DELETE':
+            for histogram in self.histograms.values():
+                histogram.reset()
+            self.profiler.reset()
+            return swob.HTTPNoContent(request=req)
+
+        return swob.HTTPMethodNotAllowed(request=req)
+
+    def get_stats(self):
+        """ Returns a dictionary with histograms and profiler counters """
+        stats = dict((name, histogram.to_dict())
+                     for name, histogram in self.histograms.items())
+        stats['profiler'] = self.profiler.to_dict()
+        if self.publisher is not None:
+            stats['publisher'] = self.publisher.to_dict()
+        stats['sinks'] = dict((name, sink.to_dict())
+                              for name, sink in self.sinks.items())
+
+        return stats
+
     def is_suitable_for_indexing(self, req):
         """
         Wheter the request is suitable for indexing. Conditions:
 
          * Authorized
          * Method: PUT, POST or DELETE
-         * Object request
-         * Account or Container must have ``enqueue`` meta set to True
+         * Object request; or container/account request, if enabled
+         * Account or Container must have ``enqueue`` meta set to True, or
+           the container/account request must change it
+         * Object must match the container enqueue rules, if any
 
          :param req
          :returns: True if the request is able to indexing; False otherwise.
@@ -154,7 +469,8 @@ class Enqueue(object):
             return False
 
         # Verify url
-        if not self._is_valid_object_url(req):
+        level = self._get_level(req)
+        if level not in self.levels:
             reason = 'Invalid object URL'
             self.logger.debug(log_msg, req.method, req.path_info, reason)
             return False
@@ -165,43 +481,56 @@ class Enqueue(object):
             self.logger.debug(log_msg, req.method, req.path_info, reason)
             return False
 
+        # Verify container enqueue rules
+        if level == LEVEL_OBJECT and not self._matches_rules(req):
+            reason = 'Filtered by container rules'
+            self.logger.debug(log_msg, req.method, req.path_info, reason)
+            return False
+
         return True
 
-    def send_req_to_queue(self, channel, req):
+    def send_req_to_queue(self, req):
         """
-        Sends a message to the channel with the proper information.
-        If the fistr try to send fails, try to reconnect to the channel and
-        try to send it again
+        Serializes the request information once and hands the same event
+        to every sink. The message is written in background; a sink drops
+        it if its buffer is full, or if it is blocked (e.g. the broker is
+        blocking publishes with ``flow_control = shed``).
         """
-        message = self._mk_message(req)
-        result = None
-        queue_name = self.conf.get('queue_name')
-
-        # First try to send to channel
-        try:
-            result = self._publish(channel, queue_name, message)
-
-        except (pika.exceptions.ConnectionClosed, Exception):
-            self.logger.exception('Enqueue: Exception on sending to queue')
-
-            # Second try to send to queue
-            # Update the queue property
-            self.channel = start_channel_conn(self.conf, self.logger)
-            if self.channel:
-                result = self._publish(self.channel, queue_name, message)
-
-        if result:
+        with self.histograms['serialization'].time():
+            body = json.dumps(self._mk_message(req))
+
+        self._install_hooks()
+
+        event = Event(req.method, body, self._get_trans_id(req))
+        sent = True
+        for name, sink in self.sinks.items():
+            if sink.submit(event):
+                continue
+
+            sent = False
+            if sink.blocked:
+                reason = 'sink is blocked'
+            else:
+                reason = 'buffer is full'
+            self.logger.error('Enqueue: %s %s dropped by sink %s, %s',
+                              req.method, req.path_info, name, reason)
+
+        if sent:
             self.logger.info(
                 'Enqueue: %s %s sent to queue',
                 req.method, req.path_info)
-        else:
-            self.logger.error(
-                'Enqueue: %s %s failed to send',
-                req.method, req.path_info)
 
-    def _filter_headers(self, req):
+    def _filter_headers(self, req, level=LEVEL_OBJECT):
         headers = {}
 
+        if level != LEVEL_OBJECT:
+            # Account and container events only send their meta headers
+            for key in req.headers.keys():
+                if key.lower().startswith(META_PREFIXES[level]):
+                    headers[key] = req.headers.get(key)
+
+            return headers
+
         for key in req.headers.keys():
             # We only send allowed headers and ``x-object-meta`` headers
             if key.lower() in ALLOWED_HEADERS or \
@@ -211,62 +540,113 @@ class Enqueue(object):
 
         return headers
 
+    def _get_trans_id(self, req):
+        return req.environ.get('swift.trans_id') or \
+            req.headers.get('x-trans-id')
+
     def _mk_message(self, req):
         """
         Creates a dictionary with the information that will be send to the
         queue.
+
+        ``trace`` has the transaction id and the times (seconds since the
+        epoch) the request reached the middleware and the message was
+        enqueued. The publish time is sent in the message properties.
         """
+        level = self._get_level(req)
+
         return {
             'uri': req.path_info,
+            'type': level,
             'http_method': req.method,
-            'headers': self._filter_headers(req),
-            'timestamp': datetime.utcnow().isoformat()
+            'headers': self._filter_headers(req, level),
+            'timestamp': datetime.utcnow().isoformat(),
+            'trace': {
+                'trans_id': self._get_trans_id(req),
+                'request_ts': req.environ.get(ENV_ARRIVAL),
+                'enqueue_ts': time.time(),
+            }
         }
 
-    def _publish(self, channel, queue, message):
-        """ Send message to the queue
-
-        :param channel pika Channel instance
-        :param queue string Queue name
-        :param message Dictionary with data
-        :returns: True if success; False otherwise.
-        """
-        return channel.basic_publish(
-            exchange='',
-            routing_key=queue,
-            body=json.dumps(message),
-            properties=pika.BasicProperties(delivery_mode=2)
-        )
-
     def _is_valid_method(self, req):
         """ Return True if the request method is allowed. False otherwise. """
         return req.method in ALLOWED_METHODS
 
-    def _is_valid_object_url(self, req):
-        """ Return True if it is a object url. False otherwise. """
+    def _get_level(self, req):
+        """
+        Return ``LEVEL_ACCOUNT``, ``LEVEL_CONTAINER`` or ``LEVEL_OBJECT``
+        for a Swift API url. None otherwise.
+        """
         try:
-            _, _, con, obj = req.split_path(2, 4, rest_with_last=True)
+            ver, _, con, obj = req.split_path(2, 4, rest_with_last=True)
         except ValueError:
-            return False
+            return None
+
+        if not valid_api_version(ver):
+            return None
 
         # con = None: account URI | obj = None: container URI
-        if con is None or obj is None:
-            return False
+        if con is None:
+            return LEVEL_ACCOUNT
 
-        return True
+        if obj is None:
+            return LEVEL_CONTAINER
+
+        return LEVEL_OBJECT
+
+    def _is_valid_object_url(self, req):
+        """ Return True if it is a object url. False otherwise. """
+        return self._get_level(req) == LEVEL_OBJECT
 
     def _has_optin_header(self, req):
         """
-        Return True if container or account has the enabling header.
+        Return True if container or account has the enabling header, or
+        if an account/container request sets or removes it.
         False otherwise.
         """
-        sysmeta_a = get_account_info(req.environ, self.app)['meta']
-        enabled_a = sysmeta_a.get(META_ENQUEUE_ENABLED)
+        level = self._get_level(req)
 
-        sysmeta_c = get_container_info(req.environ, self.app)['meta']
+        with self.histograms['info'].time():
+            sysmeta_a = get_account_info(req.environ, self.app)['meta']
+            sysmeta_c = {}
+            if level != LEVEL_ACCOUNT:
+                sysmeta_c = get_container_info(req.environ, self.app)['meta']
+
+        enabled_a = sysmeta_a.get(META_ENQUEUE_ENABLED)
         enabled_c = sysmeta_c.get(META_ENQUEUE_ENABLED)
 
-        return utils.config_true_value(enabled_c or enabled_a)
+        if utils.config_true_value(enabled_c or enabled_a):
+            return True
+
+        if level == LEVEL_OBJECT:
+            return False
+
+        # Flag changes are published, so consumers know about them
+        return any(prefix + META_ENQUEUE_ENABLED in req.headers
+                   for prefix in META_PREFIXES[level])
+
+    def _matches_rules(self, req):
+        """
+        Return True if the object matches the container enqueue rules or if
+        the container has no rules. False otherwise.
+        """
+        # Container info is cached in the environ by _has_optin_header
+        meta = get_container_info(req.environ, self.app)['meta']
+        rules = self.rules_cache.get(meta)
+        if rules is None:
+            return True
+
+        _, _, _, obj = req.split_path(4, 4, rest_with_last=True)
+
+        content_type = req.headers.get('content-type')
+        if content_type is None and req.method == 'PUT':
+            # Same guess the proxy does for objects without content type
+            content_type = mimetypes.guess_type(obj)[0] or \
+                'application/octet-stream'
+        if content_type:
+            content_type = content_type.split(';')[0].strip()
+
+        return rules.match(req.method, obj, content_type)
 
 
 def filter_factory(global_conf, **local_conf):
@@ -0,0 +1,750 @@
+"""
+Background publisher for the ``metadata_enqueue`` middleware.
+
+Events are routed by HTTP method to lanes. Each lane has its own buffer and
+in-flight budget, and lanes are always drained in priority order, so urgent
+events (e.g. DELETE) overtake a backlog of bulk uploads.
+
+Lanes are configured in the filter section:
+
+    # Lane mode: ``queue`` publishes each lane to its own queue,
+    # ``priority`` publishes every lane to ``queue_name``, declared with
+    # ``x-max-priority``, using the lane priority as message priority.
+    lane_mode = queue
+    lanes = delete, metadata
+    lane_delete_methods = DELETE
+    lane_delete_priority = 9
+    lane_metadata_methods = PUT POST
+    lane_metadata_priority = 1
+
+    # Defaults for every lane; may be overridden by lane_<name>_buffer_size
+    # and lane_<name>_inflight
+    buffer_size = 10000
+    inflight = 64
+
+    # Publisher greenpool (see ``Publisher``)
+    publisher_min_workers = 1
+    publisher_max_workers = 4
+    publisher_scale_depth = 1000
+    publisher_idle_timeout = 30
+    publish_window = 32
+    publish_transactional = false
+    publish_timeout = 10
+
+    # While the broker blocks publishing: ``spool`` (default if spool_dir is
+    # set) or ``shed`` (default otherwise)
+    flow_control = spool
+    blocked_backoff = 30
+
+    # Seconds between scans of spool_dir for events to publish again
+    spool_replay_interval = 60
+
+In ``queue`` mode the queue of a lane defaults to ``<queue_name>_<lane>``
+and may be set with ``lane_<name>_queue``. Methods not assigned to any lane
+go to the lowest priority one. Without ``lanes``, every event goes to a
+single lane publishing to ``queue_name``.
+"""
+import collections
+import time
+
+import eventlet
+import pika
+
+from eventlet import queue as eventlet_queue
+from eventlet import tpool
+from swift.common import utils
+
+from metadata_enqueue.lag import PUBLISHED_AT_HEADER
+
+DEFAULT_LANE = 'default'
+LANE_MODES = ('queue', 'priority')
+
+DEFAULT_BUFFER_SIZE = 10000
+DEFAULT_INFLIGHT = 64
+DEFAULT_RETRY_INTERVAL = 1.0
+
+DEFAULT_WINDOW = 32
+DEFAULT_MAX_WORKERS = 4
+DEFAULT_SCALE_DEPTH = 1000
+DEFAULT_IDLE_TIMEOUT = 30.0
+DEFAULT_PUBLISH_TIMEOUT = 10.0
+DEFAULT_BLOCKED_BACKOFF = 30.0
+DEFAULT_REPLAY_INTERVAL = 60.0
+
+# What to do with new events while the broker blocks the connection
+FLOW_CONTROL_SPOOL = 'spool'
+FLOW_CONTROL_SHED = 'shed'
+FLOW_CONTROLS = (FLOW_CONTROL_SPOOL, FLOW_CONTROL_SHED)
+
+FLUSH_POLL_INTERVAL = 0.05
+
+
+class PublishTimeout(Exception):
+    """ Connecting or publishing a batch took longer than allowed """
+
+
+class Event(object):
+    """
+    A serialized message waiting to be published.
+
+    ``trans_id`` is published as the AMQP ``correlation_id``; ``enqueued_at``
+    is the time the event entered the buffer.
+    """
+
+    __slots__ = ('method', 'body', 'trans_id', 'enqueued_at')
+
+    def __init__(self, method, body, trans_id=None, enqueued_at=None):
+        self.method = method
+        self.body = body
+        self.trans_id = trans_id
+        self.enqueued_at = enqueued_at or time.time()
+
+    def to_dict(self):
+        return dict((key, getattr(self, key)) for key in self.__slots__)
+
+
+class Lane(object):
+    """
+    A bounded buffer of events sharing a queue and a priority.
+
+    ``inflight`` is the budget of events the publisher workers may take from
+    this lane before the taken ones are published. Once the budget is used,
+    the workers go back to the most urgent lanes.
+    """
+
+    def __init__(self, name, methods, queue, priority=0,
+                 buffer_size=DEFAULT_BUFFER_SIZE, inflight=DEFAULT_INFLIGHT):
+        self.name = name
+        self.methods = methods
+        self.queue = queue
+        self.priority = priority
+        self.buffer_size = buffer_size
+        self.inflight_budget = inflight
+
+        self.buffer = collections.deque()
+        self.inflight = 0
+        self.dropped = 0
+        self.shed = 0
+
+    def full(self):
+        return len(self.buffer) >= self.buffer_size
+
+    def put(self, event):
+        """ Returns False, dropping the event, if the buffer is full """
+        if self.full():
+            self.dropped += 1
+            return False
+
+        self.buffer.append(event)
+        return True
+
+    def take(self, limit=None):
+        """ Takes up to ``limit`` events, as the in-flight budget allows """
+        count = min(len(self.buffer), self.inflight_budget - self.inflight)
+        if limit is not None:
+            count = min(count, limit)
+        events = [self.buffer.popleft() for _ in range(max(count, 0))]
+        self.inflight += len(events)
+
+        return events
+
+    def done(self, count):
+        self.inflight -= count
+
+    def requeue(self, events):
+        """ Gives back events that could not be published, keeping order """
+        self.buffer.extendleft(reversed(events))
+        self.inflight -= len(events)
+
+    def to_dict(self):
+        return {
+            'queue': self.queue,
+            'priority': self.priority,
+            'buffered': len(self.buffer),
+            'inflight': self.inflight,
+            'dropped': self.dropped,
+            'shed': self.shed,
+        }
+
+
+def parse_lanes(conf, methods):
+    """
+    Builds the lanes described in ``conf``, most urgent first.
+
+    :param conf: filter configuration
+    :param methods: every method that may be published
+    :returns: list of ``Lane``
+    :raises ValueError: if ``lane_mode`` is unknown
+    """
+    mode = conf.get('lane_mode', 'queue')
+    if mode not in LANE_MODES:
+        raise ValueError('Invalid lane_mode: %s' % mode)
+
+    queue_name = conf.get('queue_name')
+    buffer_size = int(conf.get('buffer_size', DEFAULT_BUFFER_SIZE))
+    inflight = int(conf.get('inflight', DEFAULT_INFLIGHT))
+
+    names = utils.list_from_csv(conf.get('lanes'))
+    if not names:
+        return [Lane(DEFAULT_LANE, list(methods), queue_name,
+                     buffer_size=buffer_size, inflight=inflight)]
+
+    lanes = []
+    for name in names:
+        prefix = 'lane_%s_' % name
+
+        if mode == 'queue':
+            queue = conf.get(prefix + 'queue', '%s_%s' % (queue_name, name))
+        else:
+            queue = queue_name
+
+        lanes.append(Lane(
+            name,
+            conf.get(prefix + 'methods', '').upper().split(),
+            queue,
+            priority=int(conf.get(prefix + 'priority', 0)),
+            buffer_size=int(conf.get(prefix + 'buffer_size', buffer_size)),
+            inflight=int(conf.get(prefix + 'inflight', inflight))))
+
+    lanes.sort(key=lambda lane: -lane.priority)
+
+    # Unassigned methods go to the lowest priority lane
+    assigned = set(m for lane in lanes for m in lane.methods)
+    lanes[-1].methods.extend(m for m in methods if m not in assigned)
+
+    return lanes
+
+
+def queue_declarations(conf, lanes):
+    """
+    Returns the ``(queue, arguments)`` pairs to be declared for ``lanes``.
+    """
+    arguments = None
+    if conf.get('lane_mode') == 'priority':
+        arguments = {'x-max-priority': max(lane.priority for lane in lanes)}
+
+    declarations = []
+    for lane in lanes:
+        if lane.queue not in [queue for queue, _ in declarations]:
+            declarations.append((lane.queue, arguments))
+
+    return declarations
+
+
+class Worker(object):
+    """
+    State of a publisher greenthread. Each worker owns its own connection
+    and channel, so workers publish concurrently.
+    """
+
+    def __init__(self, publisher):
+        self.publisher = publisher
+        self.channel = None
+
+    def connect(self):
+        publisher = self.publisher
+        try:
+            with eventlet.Timeout(publisher.publish_timeout, PublishTimeout):
+                channel = publisher.connect()
+                if channel and publisher.transactional:
+                    channel.tx_select()
+
+            if channel:
+                connection = channel.connection
+                connection.add_on_connection_blocked_callback(
+                    self._on_blocked)
+                connection.add_on_connection_unblocked_callback(
+                    self._on_unblocked)
+
+            return channel
+        except Exception:
+            publisher.logger.exception('Enqueue: Fail to connect to queue')
+            return None
+
+    def close(self):
+        """ Closes the connection, waiting up to ``publish_timeout`` """
+        channel, self.channel = self.channel, None
+        try:
+            with eventlet.Timeout(self.publisher.publish_timeout,
+                                  PublishTimeout):
+                channel.connection.close()
+        except Exception:
+            pass
+
+    def _on_blocked(self, *args):
+        self.publisher.logger.warning(
+            'Enqueue: Broker blocked the connection, holding events')
+        self.publisher.block()
+
+    def _on_unblocked(self, *args):
+        self.publisher.logger.info('Enqueue: Broker unblocked the connection')
+        self.publisher.unblock()
+
+    def poll(self, timeout):
+        """
+        Waits up to ``timeout`` seconds for broker notifications, such as
+        ``connection.unblocked``, which are only read along with other I/O.
+        """
+        try:
+            self.channel.connection.process_data_events(time_limit=timeout)
+        except (pika.exceptions.ConnectionClosed, Exception):
+            self.publisher.logger.exception(
+                'Enqueue: Connection lost while blocked')
+            self.close()
+
+    def send(self, lane, events):
+        """
+        Publishes a batch of events. If the first try fails, reconnects to
+        the queue and tries again, unless the broker is blocking publishes.
+        Each try is bounded by ``publish_timeout``; a timeout is handled as
+        a blocked connection.
+
+        :returns: True if the whole batch was published; False otherwise.
+        """
+        publisher = self.publisher
+
+        for _ in range(2):
+            # If channel is None, start connection
+            self.channel = self.channel or self.connect()
+            if not self.channel:
+                return False
+
+            try:
+                with eventlet.Timeout(publisher.publish_timeout,
+                                      PublishTimeout):
+                    publisher.publish_batch(self.channel, lane, events)
+                return True
+            except (pika.exceptions.ConnectionClosed, Exception) as err:
+                publisher.logger.exception(
+                    'Enqueue: Exception on sending to queue')
+                self.close()
+
+                if isinstance(err, PublishTimeout):
+                    publisher.block()
+                elif publisher.topology:
+                    publisher.topology.on_publish_error(err)
+
+            if publisher.blocked:
+                break
+
+        return False
+
+
+class Publisher(object):
+    """
+    Publishes buffered events from a pool of background greenthreads.
+
+    Workers are spawned on demand: one for every ``publisher_scale_depth``
+    buffered events, between ``publisher_min_workers`` and
+    ``publisher_max_workers``. Extra workers exit once the buffer depth no
+    longer needs them, or after being idle for ``publisher_idle_timeout``
+    seconds.
+
+    Each worker takes up to ``publish_window`` events from the most urgent
+    lane and writes them back to back on its channel, without waiting for
+    the broker between messages. With ``publish_transactional`` set, each
+    batch is committed in a transaction, costing one round trip per batch
+    instead of per message; a failed batch is published again.
+
+    Connecting and publishing a batch are bounded by ``publish_timeout``.
+    Publishing stops when the broker blocks a connection
+    (``connection.blocked``, sent on memory or disk alarms, which are
+    broker-wide) or a publish times out, until ``connection.unblocked``
+    arrives or ``blocked_backoff`` seconds pass. Meanwhile, new events are
+    dropped with ``flow_control = shed``; with ``flow_control = spool`` they
+    are buffered and full buffers are moved to the spool, to be published
+    again once the broker accepts events.
+
+    :param conf: filter configuration
+    :param logger: logger instance
+    :param lanes: list of ``Lane``, most urgent first
+    :param connect: callable returning a channel, or None on failure
+    :param histogram: optional ``Histogram`` recording batch publish time
+    :param buffer_histogram: optional ``Histogram`` recording the time
+                             events wait in the buffer
+    :param topology: optional ``Topology``, told about publish errors
+    :param spool: optional ``Spool`` receiving the events left on shutdown;
+                  the workers scan it every ``spool_replay_interval``
+                  seconds, starting when the first one is spawned, and
+                  publish again the events spooled by other processes
+    """
+
+    def __init__(self, conf, logger, lanes, connect, histogram=None,
+                 buffer_histogram=None, topology=None, spool=None):
+        self.logger = logger
+        self.lanes = lanes
+        self.connect = connect
+        self.histogram = histogram
+        self.buffer_histogram = buffer_histogram
+        self.topology = topology
+        self.spool = spool
+
+        self.exchange = conf.get('exchange', '')
+        self.priority_mode = conf.get('lane_mode') == 'priority'
+        self.retry_interval = float(
+            conf.get('retry_interval', DEFAULT_RETRY_INTERVAL))
+
+        self.window = int(conf.get('publish_window', DEFAULT_WINDOW))
+        self.transactional = utils.config_true_value(
+            conf.get('publish_transactional', False))
+        self.min_workers = int(conf.get('publisher_min_workers', 1))
+        self.max_workers = max(
+            int(conf.get('publisher_max_workers', DEFAULT_MAX_WORKERS)),
+            self.min_workers)
+        self.scale_depth = int(
+            conf.get('publisher_scale_depth', DEFAULT_SCALE_DEPTH))
+        self.idle_timeout = float(
+            conf.get('publisher_idle_timeout', DEFAULT_IDLE_TIMEOUT))
+        self.publish_timeout = float(
+            conf.get('publish_timeout', DEFAULT_PUBLISH_TIMEOUT)) or None
+
+        self.blocked_backoff = float(
+            conf.get('blocked_backoff', DEFAULT_BLOCKED_BACKOFF))
+        self.blocked_until = 0
+
+        self.flow_control = conf.get('flow_control', FLOW_CONTROL_SPOOL
+                                     if spool else FLOW_CONTROL_SHED)
+        if self.flow_control not in FLOW_CONTROLS:
+            raise ValueError('Invalid flow_control: %s' % self.flow_control)
+        if self.flow_control == FLOW_CONTROL_SPOOL and spool is None:
+            raise ValueError('flow_control = spool requires spool_dir')
+
+        self.routes = {}
+        for lane in reversed(lanes):
+            self.routes.update((method, lane) for method in lane.methods)
+
+        self.workers = 0
+        self.batches = []
+        self._spilling = False
+        self.pool = eventlet.GreenPool(self.max_workers)
+        self._doorbell = eventlet_queue.LightQueue(maxsize=1)
+        self.replay_interval = float(
+            conf.get('spool_replay_interval', DEFAULT_REPLAY_INTERVAL))
+        self._next_replay = 0
+
+    def submit(self, event):
+        """
+        Buffers an event to be published. Never blocks.
+
+        :returns: True if buffered; False if the lane buffer is full or the
+                  event was shed while the broker blocks publishing.
+        """
+        lane = self._route(event)
+
+        if self.blocked:
+            if self.flow_control == FLOW_CONTROL_SHED:
+                lane.shed += 1
+                return False
+
+            # Moves the buffer to disk instead of dropping events. Events
+            # are dropped while a previous buffer is still being written.
+            if lane.full() and not self._spilling:
+                self._spill_lane(lane)
+
+        if not lane.put(event):
+            return False
+
+        self._scale()
+        self._ring()
+
+        return True
+
+    @property
+    def blocked(self):
+        """ Whether the broker is blocking publishes """
+        return time.time() < self.blocked_until
+
+    def block(self):
+        """ Stops publishing until ``unblock`` or ``blocked_backoff`` """
+        self.blocked_until = time.time() + self.blocked_backoff
+
+    def unblock(self):
+        self.blocked_until = 0
+        self._ring()
+
+    def _route(self, event):
+        return self.routes.get(event.method, self.lanes[-1])
+
+    def replay(self):
+        """
+        Buffers again the events spooled by this and other processes.
+        Events that do not fit in the buffers are spooled again. Runs in the
+        publisher workers, never in a request.
+
+        :returns: number of events buffered
+        """
+        self._next_replay = time.time() + self.replay_interval
+        if self.spool is None:
+            return 0
+
+        count = 0
+        for path in self.spool.claim():
+            try:
+                count += self._replay_file(path)
+            except (IOError, OSError):
+                self.logger.exception('Enqueue: Fail to replay %s', path)
+
+        if count:
+            self.logger.info('Enqueue: %d spooled events replayed', count)
+            self._scale()
+            self._ring()
+
+        return count
+
+    def _replay_file(self, path):
+        count = 0
+        rejected = []
+        for record in self.spool.read(path):
+            try:
+                event = Event(**record)
+            except TypeError:
+                self.logger.error('Enqueue: Invalid spool record in %s', path)
+                continue
+
+            if self._route(event).put(event):
+                count += 1
+            else:
+                rejected.append(event)
+
+        self.spool.write(rejected)
+        self.spool.remove(path)
+
+        return count
+
+    def flush(self, timeout):
+        """
+        Waits up to ``timeout`` seconds for buffered and in-flight events to
+        be published.
+
+        :returns: True if every event was published; False otherwise.
+        """
+        deadline = time.time() + timeout
+
+        if self.pending():
+            self._scale()
+            self._ring()
+
+        while self.busy() and time.time() < deadline:
+            eventlet.sleep(FLUSH_POLL_INTERVAL)
+
+        return not self.busy()
+
+    def spill(self):
+        """
+        Moves every buffered event to the spool, along with the batches
+        being published (on shutdown), which may thus be published twice.
+
+        :returns: number of events spooled
+        """
+        events = []
+        for lane in self.lanes:
+            events.extend(lane.buffer)
+            lane.buffer.clear()
+
+        for batch in self.batches:
+            events.extend(batch)
+
+        return self._write_spool(events)
+
+    def _spill_lane(self, lane):
+        """
+        Moves the buffer of ``lane`` to the spool from a greenthread, with
+        the disk work in a native thread, so the request is not delayed.
+        """
+        events, lane.buffer = lane.buffer, collections.deque()
+
+        self._spilling = True
+        eventlet.spawn_n(self._spool_in_background, events)
+
+    def _spool_in_background(self, events):
+        try:
+            self._write_spool(events, tpool.execute)
+        finally:
+            self._spilling = False
+
+    def _write_spool(self, events, execute=None):
+        if not events:
+            return 0
+
+        if self.spool is None:
+            self.logger.error('Enqueue: %d events lost, no spool_dir set',
+                              len(events))
+            return 0
+
+        try:
+            if execute is None:
+                return self.spool.write(events)
+            return execute(self.spool.write, events)
+        except (IOError, OSError):
+            self.logger.exception('Enqueue: %d events lost, fail to spool',
+                                  len(events))
+            return 0
+
+    def _ring(self):
+        try:
+            self._doorbell.put_nowait(None)
+        except eventlet_queue.Full:
+            pass
+
+    def _wanted(self):
+        """ Number of workers for the current buffer depth """
+        depth = sum(len(lane.buffer) for lane in self.lanes)
+        wanted = min(1 + depth // self.scale_depth, self.max_workers)
+
+        return max(wanted, self.min_workers)
+
+    def _scale(self):
+        """
+        Spawns workers according to the buffer depth. Retired workers keep
+        their pool slot until their connection is closed; ``spawn_n`` would
+        block on a full pool, so no worker is spawned meanwhile.
+        """
+        while self.workers < self._wanted() and self.pool.free():
+            self.workers += 1
+            self.pool.spawn_n(self.run)
+
+    def pending(self):
+        return any(lane.buffer for lane in self.lanes)
+
+    def busy(self):
+        return any(lane.buffer or lane.inflight for lane in self.lanes)
+
+    def ready(self):
+        """
+        Whether the broker accepts events and any lane has events and
+        in-flight budget left.
+        """
+        if self.blocked:
+            return False
+
+        return any(lane.buffer and lane.inflight < lane.inflight_budget
+                   for lane in self.lanes)
+
+    def run(self):
+        worker = Worker(self)
+        try:
+            while True:
+                if self.blocked:
+                    # connection.unblocked is only read along with I/O
+                    if worker.channel:
+                        worker.poll(self.retry_interval)
+                    else:
+                        eventlet.sleep(self.retry_interval)
+
+                    if not self.blocked:
+                        # Publishes what was spooled while blocked
+                        self.replay()
+                        self._ring()
+                    continue
+
+                if time.time() >= self._next_replay:
+                    self.replay()
+
+                try:
+                    self._doorbell.get(timeout=self.idle_timeout)
+                except eventlet_queue.Empty:
+                    if self.workers > self.min_workers:
+                        return
+                    continue
+
+                while self.ready():
+                    try:
+                        published = self.drain(worker)
+                    except Exception:
+                        self.logger.exception('Enqueue: Publisher failure')
+                        published = False
+
+                    if not published:
+                        eventlet.sleep(self.retry_interval)
+
+                    # The buffer shrank: extra workers retire
+                    if self.workers > self._wanted():
+                        return
+        finally:
+            self.workers -= 1
+            if worker.channel:
+                worker.close()
+
+    def drain(self, worker):
+        """
+        Publishes one batch from the most urgent lane with buffered events.
+
+        :returns: False if the batch could not be published; True otherwise.
+        """
+        for lane in self.lanes:
+            events = lane.take(self.window)
+            if events:
+                break
+        else:
+            return True
+
+        # Wakes up another worker to take the next batch meanwhile
+        if self.ready():
+            self._ring()
+
+        # Kept to be spooled if the process exits while publishing them
+        self.batches.append(events)
+        try:
+            sent = worker.send(lane, events)
+        finally:
+            self.batches.remove(events)
+
+        if not sent:
+            lane.requeue(events)
+            return False
+
+        lane.done(len(events))
+
+        # Budget released: waiting workers may take more events
+        if self.ready():
+            self._ring()
+
+        return True
+
+    def publish_batch(self, channel, lane, events):
+        if self.histogram is None:
+            return self._publish_batch(channel, lane, events)
+
+        with self.histogram.time():
+            return self._publish_batch(channel, lane, events)
+
+    def _publish_batch(self, channel, lane, events):
+        for event in events:
+            self._publish(channel, lane, event)
+
+        if self.transactional:
+            channel.tx_commit()
+
+    def _publish(self, channel, lane, event):
+        """ Send message to the lane queue
+
+        :param channel pika Channel instance
+        :param lane Lane instance
+        :param event Event instance
+        """
+        now = time.time()
+        if self.buffer_histogram is not None:
+            self.buffer_histogram.record(now - event.enqueued_at)
+
+        properties = {
+            'delivery_mode': 2,
+            'correlation_id': event.trans_id,
+            'timestamp': int(now),
+            'headers': {PUBLISHED_AT_HEADER: '%.6f' % now},
+        }
+        if self.priority_mode:
+            properties['priority'] = lane.priority
+
+        channel.basic_publish(
+            exchange=self.exchange,
+            routing_key=lane.queue,
+            body=event.body,
+            properties=pika.BasicProperties(**properties)
+        )
+
+    def to_dict(self):
+        return {
+            'workers': self.workers,
+            'blocked': self.blocked,
+            'lanes': dict((lane.name, lane.to_dict()) for lane in self.lanes),
+        }
@@ -0,0 +1,100 @@
+"""
+Per-container enqueue rules for the ``metadata_enqueue`` middleware.
+
+Containers with the ``enqueue`` flag may restrict which object events are
+published, using the following metadata (comma-separated values):
+
+    # fnmatch globs on the object name, e.g. a prefix or a suffix
+    swift post container -m "enqueue-names:images/*,*.jpg"
+
+    # fnmatch globs on the content type
+    swift post container -m "enqueue-content-types:image/*,application/pdf"
+
+    # methods to publish
+    swift post container -m "enqueue-methods:PUT,DELETE"
+
+An event is published only if it matches every rule set. Content type rules
+are not applied to requests without a content type (e.g. DELETE).
+
+Rules are compiled once and cached by their raw metadata values, so
+evaluating them costs a dictionary lookup and a few regex matches.
+"""
+import collections
+import fnmatch
+import re
+
+from swift.common import utils
+
+META_RULE_NAMES = 'enqueue-names'
+META_RULE_CONTENT_TYPES = 'enqueue-content-types'
+META_RULE_METHODS = 'enqueue-methods'
+
+DEFAULT_CACHE_SIZE = 1024
+
+
+def compile_globs(value):
+    """
+    Compiles comma-separated globs in a single regex.
+
+    :returns: compiled regex; None if there is no glob.
+    """
+    globs = utils.list_from_csv(value)
+    if not globs:
+        return None
+
+    return re.compile('|'.join('(?:%s)' % fnmatch.translate(glob)
+                               for glob in globs))
+
+
+class Rules(object):
+    """ Compiled enqueue rules of a container """
+
+    def __init__(self, names=None, content_types=None, methods=None):
+        self.names = compile_globs(names)
+        self.content_types = compile_globs(content_types)
+        self.methods = frozenset(
+            method.upper() for method in utils.list_from_csv(methods))
+
+    def match(self, method, obj, content_type=None):
+        """ Return True if the event should be published """
+        if self.methods and method not in self.methods:
+            return False
+
+        if self.names and not self.names.match(obj):
+            return False
+
+        if self.content_types and content_type and \
+           not self.content_types.match(content_type):
+            return False
+
+        return True
+
+
+class RulesCache(object):
+    """ LRU cache of compiled ``Rules``, keyed by their raw metadata """
+
+    def __init__(self, size=DEFAULT_CACHE_SIZE):
+        self.size = size
+        self._cache = collections.OrderedDict()
+
+    def get(self, meta):
+        """
+        Returns the ``Rules`` set in a container metadata dictionary; None
+        if the container has no rules.
+        """
+        key = (meta.get(META_RULE_NAMES),
+               meta.get(META_RULE_CONTENT_TYPES),
+               meta.get(META_RULE_METHODS))
+
+        if not any(key):
+            return None
+
+        rules = self._cache.pop(key, None)
+        if rules is None:
+            rules = Rules(*key)
+            if len(self._cache) >= self.size:
+                self._cache.popitem(last=False)
+
+        self._cache[key] = rules
+
+        return rules
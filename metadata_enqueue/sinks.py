@@ -0,0 +1,331 @@
+"""
+Sinks the ``metadata_enqueue`` middleware fans events out to.
+
+Each event is classified and serialized once, and the same ``Event`` is
+handed to every sink. Every sink has its own bounded buffer and writer, so a
+slow or failing sink only drops its own events and never blocks the others
+nor the request. Without ``sinks``, events are published to the broker set
+in the filter section, as a single ``amqp`` sink.
+
+Sinks are configured in the filter section. Options of a sink are read from
+``sink_<name>_<option>``, falling back to the filter option:
+
+    sinks = amqp, audit, indexer, replica
+
+    # Append-only log file, one JSON message per line
+    sink_audit_type = file
+    sink_audit_path = /var/log/swift/enqueue.log
+    sink_audit_fsync = false
+
+    # UNIX stream socket, one JSON message per line
+    sink_indexer_type = unix
+    sink_indexer_path = /run/indexer.sock
+
+    # Second broker
+    sink_replica_type = amqp
+    sink_replica_queue_url = rabbitmq2.example.com
+    sink_replica_spool_dir = /var/spool/swift/metadata_enqueue_replica
+
+The type of a sink defaults to its name. Besides ``amqp``, ``file`` and
+``unix``, it may be ``package.module:Class`` to load a ``Sink`` subclass.
+"""
+import importlib
+import os
+import time
+
+import eventlet
+
+from eventlet import queue as eventlet_queue
+from eventlet import tpool
+from eventlet.green import socket
+from swift.common import utils
+
+from metadata_enqueue.publisher import DEFAULT_BUFFER_SIZE, \
+    DEFAULT_PUBLISH_TIMEOUT, DEFAULT_RETRY_INTERVAL, DEFAULT_WINDOW, \
+    FLUSH_POLL_INTERVAL, Lane, PublishTimeout
+from metadata_enqueue.stats import Histogram
+
+SINK_AMQP = 'amqp'
+SINK_PREFIX = 'sink_%s_'
+
+
+def parse_sinks(conf):
+    """
+    Returns the sinks described in ``conf``.
+
+    :param conf: filter configuration
+    :returns: list of ``(name, type, conf)``; each conf is the filter
+              configuration updated with the options of the sink
+    """
+    names = utils.list_from_csv(conf.get('sinks'))
+    if not names:
+        return [(SINK_AMQP, SINK_AMQP, conf)]
+
+    sinks = []
+    for name in names:
+        prefix = SINK_PREFIX % name
+
+        sink_conf = dict(conf)
+        sink_conf.update((key[len(prefix):], value)
+                         for key, value in conf.items()
+                         if key.startswith(prefix))
+
+        sinks.append((name, sink_conf.pop('type', name), sink_conf))
+
+    return sinks
+
+
+def load_sink(sink_type):
+    """
+    Returns the ``Sink`` class of a type other than ``amqp``.
+
+    :raises ValueError: if the type is unknown
+    """
+    if sink_type in SINK_TYPES:
+        return SINK_TYPES[sink_type]
+
+    module, _, cls = sink_type.partition(':')
+    try:
+        return getattr(importlib.import_module(module), cls)
+    except (ImportError, AttributeError, ValueError):
+        raise ValueError('Invalid sink type: %s' % sink_type)
+
+
+class Sink(object):
+    """
+    Base class of the sinks other than the broker.
+
+    Events are buffered and written in batches of up to ``publish_window``
+    by a greenthread of the sink, spawned with the first event. A batch that
+    fails or takes longer than ``publish_timeout`` is written again after
+    ``retry_interval`` seconds, reopening the sink. Events are dropped when
+    the buffer (``buffer_size``) is full.
+
+    Subclasses implement ``open``, ``write`` and ``close``.
+
+    :param name: sink name
+    :param conf: sink configuration
+    :param logger: logger instance
+    """
+
+    def __init__(self, name, conf, logger):
+        self.name = name
+        self.logger = logger
+
+        self.window = int(conf.get('publish_window', DEFAULT_WINDOW))
+        self.retry_interval = float(
+            conf.get('retry_interval', DEFAULT_RETRY_INTERVAL))
+        self.timeout = float(
+            conf.get('publish_timeout', DEFAULT_PUBLISH_TIMEOUT)) or None
+
+        self.lane = Lane(name, [], None,
+                         buffer_size=int(conf.get('buffer_size',
+                                                  DEFAULT_BUFFER_SIZE)),
+                         inflight=self.window)
+        self.histogram = Histogram()
+        self.blocked = False
+        self.errors = 0
+
+        self._running = False
+        self._doorbell = eventlet_queue.LightQueue(maxsize=1)
+
+    def open(self):
+        """ Opens the destination, if needed, before a batch is written """
+
+    def write(self, events):
+        """ Writes a batch of events. Raises on failure """
+        raise NotImplementedError()
+
+    def close(self):
+        """ Closes the destination after a failure """
+
+    def submit(self, event):
+        """
+        Buffers an event to be written. Never blocks.
+
+        :returns: True if buffered; False if the buffer is full.
+        """
+        if not self.lane.put(event):
+            return False
+
+        if not self._running:
+            self._running = True
+            eventlet.spawn_n(self.run)
+
+        try:
+            self._doorbell.put_nowait(None)
+        except eventlet_queue.Full:
+            pass
+
+        return True
+
+    def run(self):
+        try:
+            while True:
+                self._doorbell.get()
+
+                while self.lane.buffer:
+                    if not self.drain():
+                        eventlet.sleep(self.retry_interval)
+        finally:
+            self._running = False
+
+    def drain(self):
+        """
+        Writes one batch.
+
+        :returns: False if the batch could not be written; True otherwise.
+        """
+        events = self.lane.take(self.window)
+
+        try:
+            with eventlet.Timeout(self.timeout, PublishTimeout):
+                with self.histogram.time():
+                    self.open()
+                    self.write(events)
+        except Exception:
+            self.logger.exception('Enqueue: Fail to write to sink %s',
+                                  self.name)
+            self.lane.requeue(events)
+            self.blocked = True
+            self.errors += 1
+            self._close()
+            return False
+
+        self.lane.done(len(events))
+        self.blocked = False
+
+        return True
+
+    def _close(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def busy(self):
+        return bool(self.lane.buffer or self.lane.inflight)
+
+    def flush(self, timeout):
+        """
+        Waits up to ``timeout`` seconds for buffered events to be written.
+
+        :returns: True if every event was written; False otherwise.
+        """
+        deadline = time.time() + timeout
+
+        while self.busy() and time.time() < deadline:
+            eventlet.sleep(FLUSH_POLL_INTERVAL)
+
+        return not self.busy()
+
+    def spill(self):
+        """
+        Drops the buffered events, which are logged as lost along with the
+        batch being written.
+        """
+        lost = len(self.lane.buffer) + self.lane.inflight
+        self.lane.buffer.clear()
+
+        if lost:
+            self.logger.error('Enqueue: %d events lost by sink %s',
+                              lost, self.name)
+
+        return 0
+
+    def to_dict(self):
+        return {
+            'buffered': len(self.lane.buffer),
+            'inflight': self.lane.inflight,
+            'dropped': self.lane.dropped,
+            'blocked': self.blocked,
+            'errors': self.errors,
+            'write': self.histogram.to_dict(),
+        }
+
+
+def _lines(events):
+    """ Joins the event bodies, one per line, as bytes """
+    data = ''.join(event.body + '\n' for event in events)
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+
+    return data
+
+
+class FileSink(Sink):
+    """
+    Appends events to ``path``. Writes run in a native thread, so a slow
+    disk does not block the hub. With ``fsync`` set, each batch is synced
+    to disk.
+
+    A timeout cannot interrupt a native thread: writes are not bounded by
+    ``publish_timeout``, so a batch is never closed under the thread nor
+    written twice.
+    """
+
+    def __init__(self, name, conf, logger):
+        super(FileSink, self).__init__(name, conf, logger)
+        self.timeout = None
+
+        self.path = conf.get('path')
+        if not self.path:
+            raise ValueError('Sink %s: path is required' % name)
+
+        self.fsync = utils.config_true_value(conf.get('fsync', False))
+        self.fd = None
+
+    def open(self):
+        if self.fd is None:
+            self.fd = open(self.path, 'ab')
+
+    def write(self, events):
+        tpool.execute(self._write, _lines(events))
+
+    def _write(self, data):
+        self.fd.write(data)
+        self.fd.flush()
+        if self.fsync:
+            os.fsync(self.fd.fileno())
+
+    def close(self):
+        fd, self.fd = self.fd, None
+        if fd is not None:
+            fd.close()
+
+
+class UnixSocketSink(Sink):
+    """ Streams events to the UNIX socket at ``path`` """
+
+    def __init__(self, name, conf, logger):
+        super(UnixSocketSink, self).__init__(name, conf, logger)
+
+        self.path = conf.get('path')
+        if not self.path:
+            raise ValueError('Sink %s: path is required' % name)
+
+        self.sock = None
+
+    def open(self):
+        if self.sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.path)
+            except Exception:
+                sock.close()
+                raise
+            self.sock = sock
+
+    def write(self, events):
+        self.sock.sendall(_lines(events))
+
+    def close(self):
+        sock, self.sock = self.sock, None
+        if sock is not None:
+            sock.close()
+
+
+SINK_TYPES = {
+    'file': FileSink,
+    'unix': UnixSocketSink,
+}
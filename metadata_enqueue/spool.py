@@ -0,0 +1,115 @@
+"""
+Local disk spool for the ``metadata_enqueue`` middleware.
+
+Events that could not be published (e.g. still buffered when the worker
+exits) are written to ``spool_dir``, one JSON document per line, and
+published again by the next publisher that starts.
+
+Files are written under a temporary name and renamed when complete, and
+are claimed by renaming before being replayed, so several proxy workers
+may share the same directory.
+"""
+import errno
+import json
+import os
+import time
+
+SPOOL_PREFIX = 'enqueue-'
+SPOOL_SUFFIX = '.spool'
+CLAIMED_SUFFIX = '.replaying'
+
+
+class Spool(object):
+    """
+    :param path: spool directory, created if needed
+    :param logger: logger instance
+    """
+
+    def __init__(self, path, logger):
+        self.path = path
+        self.logger = logger
+
+    def _mkdir(self):
+        try:
+            os.makedirs(self.path)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+
+    def write(self, events):
+        """
+        Writes events to a new spool file.
+
+        :returns: number of events written
+        """
+        if not events:
+            return 0
+
+        self._mkdir()
+
+        name = '%s%d-%d-%d' % (SPOOL_PREFIX, time.time() * 1000000,
+                               os.getpid(), id(events))
+        final = os.path.join(self.path, name + SPOOL_SUFFIX)
+        temp = os.path.join(self.path, '.' + name)
+
+        with open(temp, 'w') as fd:
+            for event in events:
+                fd.write(json.dumps(event.to_dict()))
+                fd.write('\n')
+            fd.flush()
+            os.fsync(fd.fileno())
+
+        os.rename(temp, final)
+
+        return len(events)
+
+    def claim(self):
+        """
+        Claims every complete spool file, oldest first.
+
+        :returns: list of claimed file paths
+        """
+        try:
+            names = sorted(os.listdir(self.path))
+        except OSError:
+            return []
+
+        claimed = []
+        for name in names:
+            if not (name.startswith(SPOOL_PREFIX) and
+                    name.endswith(SPOOL_SUFFIX)):
+                continue
+
+            path = os.path.join(self.path, name)
+            try:
+                os.rename(path, path + CLAIMED_SUFFIX)
+            except OSError:
+                # Claimed by another worker
+                continue
+
+            claimed.append(path + CLAIMED_SUFFIX)
+
+        return claimed
+
+    def read(self, path):
+        """ Returns the event dictionaries stored in a claimed file """
+        records = []
+        with open(path) as fd:
+            for line in fd:
+                try:
+                    record = json.loads(line)
+                    if not isinstance(record, dict) or \
+                       'method' not in record or 'body' not in record:
+                        raise ValueError('Missing method or body')
+                    records.append(record)
+                except ValueError:
+                    self.logger.error('Enqueue: Invalid spool record in %s',
+                                      path)
+
+        return records
+
+    def remove(self, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
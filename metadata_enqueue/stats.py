@@ -0,0 +1,184 @@
+"""
+In-process latency statistics for the ``metadata_enqueue`` middleware.
+
+``Histogram`` keeps HDR-style latency histograms: values are recorded in
+microseconds and bucketed log-linearly, so memory stays bounded while the
+relative error of any percentile stays under ``1 / 2 ** (precision - 1)``.
+
+``SamplingProfiler`` runs ``cProfile`` on one in N calls and aggregates the
+results, so hot spots can be inspected in production without redeploying.
+"""
+import cProfile
+import pstats
+import time
+
+from contextlib import contextmanager
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+class Histogram(object):
+    """
+    Log-linear latency histogram.
+
+    Values below ``2 ** precision`` microseconds are counted exactly. Bigger
+    values keep only their ``precision`` most significant bits.
+    """
+
+    def __init__(self, precision=5):
+        self.precision = precision
+        self.reset()
+
+    def reset(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def _bucket(self, value):
+        shift = value.bit_length() - self.precision
+        if shift <= 0:
+            return value
+        return (value >> shift) << shift
+
+    def record(self, seconds):
+        """ Record a latency, given in seconds """
+        value = max(int(seconds * 1000000), 0)
+        bucket = self._bucket(value)
+
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    @contextmanager
+    def time(self):
+        """ Record the time spent inside the ``with`` block """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(time.time() - start)
+
+    def percentile(self, percent):
+        """ Return the value (in microseconds) at the given percentile """
+        if not self.count:
+            return 0
+
+        threshold = self.count * percent / 100.0
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= threshold:
+                return min(bucket, self.max)
+
+        return self.max
+
+    def to_dict(self):
+        result = {
+            'count': self.count,
+            'min_us': self.min or 0,
+            'max_us': self.max or 0,
+            'mean_us': self.total // self.count if self.count else 0,
+        }
+
+        for percent in PERCENTILES:
+            key = 'p%s_us' % str(percent).replace('.', '')
+            result[key] = self.percentile(percent)
+
+        return result
+
+
+class SamplingProfiler(object):
+    """
+    Profiles one in ``sample_rate`` calls. A rate of 0 disables profiling.
+
+    Every profiled call is merged into the same ``pstats.Stats``, which can
+    be rendered with ``report`` or written by ``dump`` to ``dump_path`` in
+    the format read by ``pstats`` and tools like snakeviz.
+
+    ``cProfile`` profiles the OS thread, not a greenthread: whatever other
+    greenthreads run while a sampled call yields (e.g. on network I/O) is
+    included in its profile. Only one call is profiled at a time; a sample
+    due while another one runs is skipped.
+    """
+
+    def __init__(self, sample_rate=0, dump_path=None):
+        self.sample_rate = sample_rate
+        self.dump_path = dump_path
+        self.reset()
+
+    def reset(self):
+        self.seen = 0
+        self.profiled = 0
+        self.skipped = 0
+        self._stats = None
+        self._running = False
+
+    def should_sample(self):
+        if not self.sample_rate:
+            return False
+
+        self.seen += 1
+        if self.seen % self.sample_rate:
+            return False
+
+        # Overlapping profilers would replace each other's hooks
+        if self._running:
+            self.skipped += 1
+            return False
+
+        return True
+
+    def run(self, func, *args, **kwargs):
+        """ Call ``func`` under the profiler and aggregate its stats """
+        profiler = cProfile.Profile()
+        self._running = True
+        try:
+            return profiler.runcall(func, *args, **kwargs)
+        finally:
+            self._running = False
+            self._aggregate(profiler)
+
+    def _aggregate(self, profiler):
+        profiler.create_stats()
+        self.profiled += 1
+
+        if self._stats is None:
+            self._stats = pstats.Stats(profiler)
+        else:
+            self._stats.add(profiler)
+
+    def dump(self):
+        """ Writes the aggregated stats to ``dump_path``, if set """
+        if self.dump_path and self._stats is not None:
+            self._stats.dump_stats(self.dump_path)
+
+    def report(self, limit=30):
+        """ Return the aggregated stats as text, sorted by cumulative time """
+        if self._stats is None:
+            return ''
+
+        stream = StringIO()
+        self._stats.stream = stream
+        self._stats.sort_stats('cumulative').print_stats(limit)
+
+        return stream.getvalue()
+
+    def to_dict(self):
+        return {
+            'sample_rate': self.sample_rate,
+            'seen': self.seen,
+            'profiled': self.profiled,
+            'skipped': self.skipped,
+        }
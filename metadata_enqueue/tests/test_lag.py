@@ -0,0 +1,74 @@
+import json
+import unittest
+
+from mock import Mock
+from metadata_enqueue import lag
+
+
+def message(**trace):
+    return json.dumps({'uri': '/v1/a/c/o', 'trace': trace})
+
+
+class ParseTraceTestCase(unittest.TestCase):
+
+    def test_parse_trace(self):
+        properties = Mock(correlation_id='tx1',
+                          headers={lag.PUBLISHED_AT_HEADER: '12.5'})
+        body = message(trans_id='tx1', request_ts=10.0, enqueue_ts=11.0)
+
+        trace = lag.parse_trace(properties, body.encode('utf-8'), 13.0)
+
+        self.assertEqual(trace.trans_id, 'tx1')
+        self.assertEqual(trace.request_ts, 10.0)
+        self.assertEqual(trace.enqueue_ts, 11.0)
+        self.assertEqual(trace.publish_ts, 12.5)
+        self.assertEqual(trace.received_ts, 13.0)
+
+    def test_parse_message_without_trace(self):
+        properties = Mock(correlation_id='tx2', headers=None)
+
+        trace = lag.parse_trace(properties, {'uri': '/v1/a/c/o'})
+
+        self.assertEqual(trace.trans_id, 'tx2')
+        self.assertIsNone(trace.request_ts)
+        self.assertIsNone(trace.publish_ts)
+        self.assertIsNotNone(trace.received_ts)
+
+
+class LagTrackerTestCase(unittest.TestCase):
+
+    def test_stages(self):
+        tracker = lag.LagTracker()
+        properties = Mock(headers={lag.PUBLISHED_AT_HEADER: '10.003'})
+        body = message(request_ts=10.0, enqueue_ts=10.001)
+
+        trace = tracker.received(properties, body, now=10.010)
+        tracker.processed(trace, now=10.030)
+
+        report = tracker.report()
+        self.assertEqual(set(report), set(lag.STAGES))
+        self.assertAlmostEqual(report['proxy']['max_us'], 1000, delta=2)
+        self.assertAlmostEqual(report['buffer']['max_us'], 2000, delta=2)
+        self.assertAlmostEqual(report['broker']['max_us'], 7000, delta=2)
+        self.assertAlmostEqual(report['processing']['max_us'], 20000,
+                               delta=2)
+        self.assertAlmostEqual(report['total']['max_us'], 30000, delta=2)
+
+    def test_missing_times_are_skipped(self):
+        tracker = lag.LagTracker()
+
+        trace = tracker.received(Mock(headers={}), message(), now=1.0)
+        tracker.processed(trace, now=2.0)
+
+        report = tracker.report()
+        self.assertEqual(report['processing']['count'], 1)
+        self.assertEqual(report['broker']['count'], 0)
+        self.assertEqual(report['total']['count'], 0)
+
+    def test_reset(self):
+        tracker = lag.LagTracker()
+        tracker.processed(lag.Trace(received_ts=1.0), now=2.0)
+
+        tracker.reset()
+
+        self.assertEqual(tracker.report()['processing']['count'], 0)
@@ -4,6 +4,7 @@ import unittest
 from mock import patch, Mock
 from swift.common import swob
 from metadata_enqueue import middleware as md
+from metadata_enqueue.sinks import FileSink
 
 
 class FakeApp(object):
@@ -60,22 +61,133 @@ class TestEnqueueCall(unittest.TestCase):
 
         self.send_req_to_queue.assert_not_called()
 
-    def test_start_channel_conn_returns_falsy(self):
-        """ Send to queue should not be called """
+    def test_request_does_not_wait_for_the_queue(self):
+        """ Send to queue is called, but no connection is made inline """
         patch('metadata_enqueue.middleware.Enqueue.is_suitable_for_indexing',
               Mock(return_value=True)).start()
 
-        patch('metadata_enqueue.middleware.start_channel_conn',
-              Mock(return_value=None)).start()
+        start_channel_conn = patch(
+            'metadata_enqueue.middleware.start_channel_conn',
+            Mock(return_value=None)).start()
+
+        resp = swob.Request.blank('/v1/a/c/o',
+                                  environ={'REQUEST_METHOD': 'PUT'}
+                                  ).get_response(self.app)
+
+        self.assertEqual(resp.body, b'Fake Test App')
+        self.send_req_to_queue.assert_called_once()
+        start_channel_conn.assert_not_called()
+
+    def tearDown(self):
+        patch.stopall()
+
 
+class StatsEndpointTestCase(unittest.TestCase):
+    """
+    The stats path must be answered by the middleware itself and only for
+    reseller admins.
+    """
+
+    def setUp(self):
+        self.app = md.Enqueue(FakeApp(), {})
+
+        patch('metadata_enqueue.middleware.start_channel_conn', Mock()).start()
+        patch('metadata_enqueue.middleware.Enqueue._has_optin_header',
+              Mock(return_value=True)).start()
+
+        self.send_req_to_queue = patch(
+            'metadata_enqueue.middleware.Enqueue.send_req_to_queue',
+            Mock()).start()
+
+    def tearDown(self):
+        patch.stopall()
+
+    def _request(self, path=md.DEFAULT_STATS_PATH, method='GET',
+                 reseller=True):
+        environ = {'REQUEST_METHOD': method}
+        if reseller:
+            environ['reseller_request'] = True
+
+        return swob.Request.blank(path, environ=environ).get_response(
+            self.app)
+
+    def test_stats_requires_reseller_admin(self):
+        resp = self._request(reseller=False)
+
+        self.assertEqual(resp.status_int, 403)
+
+    def test_stats_returns_histograms_as_json(self):
         swob.Request.blank('/v1/a/c/o',
                            environ={'REQUEST_METHOD': 'PUT'}
                            ).get_response(self.app)
 
+        resp = self._request()
+        computed = json.loads(resp.body)
+
+        self.assertEqual(resp.status_int, 200)
+        self.assertEqual(resp.content_type, 'application/json')
+        for name in md.HISTOGRAMS:
+            self.assertIn(name, computed)
+        self.assertEqual(computed['classification']['count'], 1)
+        self.assertIn('buffer_wait', computed)
+        self.assertEqual(computed['profiler']['sample_rate'], 0)
+
+    def test_stats_path_is_configurable(self):
+        self.app = md.Enqueue(FakeApp(), {'stats_path': '/custom'})
+
+        self.assertEqual(self._request('/custom').status_int, 200)
+        self.assertEqual(self._request().body, b'Fake Test App')
+
+    def test_stats_does_not_reach_the_app_nor_the_queue(self):
+        resp = self._request()
+
+        self.assertNotEqual(resp.body, b'Fake Test App')
         self.send_req_to_queue.assert_not_called()
 
-    def tearDown(self):
-        patch.stopall()
+    def test_post_changes_profile_sample_rate(self):
+        resp = self._request(md.DEFAULT_STATS_PATH +
+                             '?profile_sample_rate=2', method='POST')
+
+        self.assertEqual(resp.status_int, 204)
+        self.assertEqual(self.app.profiler.sample_rate, 2)
+
+        for _ in range(4):
+            swob.Request.blank('/v1/a/c/o',
+                               environ={'REQUEST_METHOD': 'PUT'}
+                               ).get_response(self.app)
+
+        self.assertEqual(self.app.profiler.profiled, 2)
+        self.assertEqual(self.send_req_to_queue.call_count, 4)
+
+        # Classification is profiled along with the enqueue
+        resp = self._request(md.DEFAULT_STATS_PATH + '?profile')
+        self.assertIn(b'function calls', resp.body)
+        self.assertIn(b'is_suitable_for_indexing', resp.body)
+
+    def test_profiler_only_samples_write_requests(self):
+        self.app.profiler.sample_rate = 1
+
+        for method in ('GET', 'HEAD', 'PUT'):
+            swob.Request.blank('/v1/a/c/o',
+                               environ={'REQUEST_METHOD': method}
+                               ).get_response(self.app)
+
+        self.assertEqual(self.app.profiler.seen, 1)
+        self.assertEqual(self.app.profiler.profiled, 1)
+
+    def test_post_with_invalid_rate_returns_bad_request(self):
+        resp = self._request(md.DEFAULT_STATS_PATH +
+                             '?profile_sample_rate=x', method='POST')
+
+        self.assertEqual(resp.status_int, 400)
+
+    def test_delete_resets_stats(self):
+        self.app.histograms['publish'].record(0.1)
+
+        resp = self._request(method='DELETE')
+
+        self.assertEqual(resp.status_int, 204)
+        self.assertEqual(self.app.histograms['publish'].count, 0)
 
 
 class StartQueueTestCase(unittest.TestCase):
@@ -158,6 +270,38 @@ class StartQueueTestCase(unittest.TestCase):
 
         self.assertIsNone(result)
 
+    def test_start_channel_conn_closes_connection_on_failure(self):
+        self.pika.exceptions.ConnectionClosed = Exception
+        connection = self.pika.BlockingConnection.return_value
+        connection.close.side_effect = Exception
+        topology = Mock()
+        topology.declare.side_effect = Exception('PRECONDITION_FAILED')
+
+        result = md.start_channel_conn(self.conf, self.logger, topology)
+
+        self.assertIsNone(result)
+        connection.close.assert_called_once()
+
+    def test_start_channel_conn_declares_given_topology(self):
+        connection = self.pika.BlockingConnection.return_value
+        channel = connection.channel.return_value
+        topology = Mock()
+
+        result = md.start_channel_conn(self.conf, self.logger, topology)
+
+        self.assertEqual(result, channel)
+        topology.declare.assert_called_once_with(channel)
+
+    def test_start_channel_conn_uses_queue_arguments(self):
+        connection = self.pika.BlockingConnection.return_value
+        channel = connection.channel.return_value
+        self.conf['queue_mode'] = 'lazy'
+
+        md.start_channel_conn(self.conf, self.logger)
+
+        channel.queue_declare.assert_called_with(
+            queue='name', durable=True, arguments={'x-queue-mode': 'lazy'})
+
 
 class EnqueueValidateRequesTestCase(unittest.TestCase):
     """
@@ -306,6 +450,302 @@ class EnqueueValidateRequesTestCase(unittest.TestCase):
         self.send_req_to_queue.assert_not_called()
 
 
+class AccountContainerEventsTestCase(unittest.TestCase):
+    """
+    Account and container events are published only if enabled, for
+    accounts/containers with the ``enqueue`` flag or changing it.
+    """
+
+    def setUp(self):
+        self.app = md.Enqueue(FakeApp(), {'container_events': 'true',
+                                          'account_events': 'true'})
+
+        self.send_req_to_queue = patch(
+            'metadata_enqueue.middleware.Enqueue.send_req_to_queue',
+            Mock()).start()
+
+        self.account_meta = {}
+        self.container_meta = {}
+        patch('metadata_enqueue.middleware.get_account_info',
+              Mock(return_value={'meta': self.account_meta})).start()
+        self.get_container_info = patch(
+            'metadata_enqueue.middleware.get_container_info',
+            Mock(return_value={'meta': self.container_meta})).start()
+
+    def tearDown(self):
+        patch.stopall()
+
+    def _request(self, path, method='PUT', headers=None):
+        swob.Request.blank(path, environ={'REQUEST_METHOD': method},
+                           headers=headers).get_response(self.app)
+
+    def test_disabled_by_default(self):
+        self.app = md.Enqueue(FakeApp(), {})
+        self.account_meta[md.META_ENQUEUE_ENABLED] = 'True'
+
+        self._request('/v1/a/c', method='DELETE')
+        self._request('/v1/a', method='POST')
+
+        self.send_req_to_queue.assert_not_called()
+
+    def test_container_events_of_enabled_account(self):
+        self.account_meta[md.META_ENQUEUE_ENABLED] = 'True'
+
+        for method in md.ALLOWED_METHODS:
+            self._request('/v1/a/c', method=method)
+
+        self.assertEqual(self.send_req_to_queue.call_count,
+                         len(md.ALLOWED_METHODS))
+
+    def test_container_events_of_enabled_container(self):
+        self.container_meta[md.META_ENQUEUE_ENABLED] = 'True'
+
+        self._request('/v1/a/c', method='DELETE')
+
+        self.send_req_to_queue.assert_called_once()
+
+    def test_container_events_of_disabled_container(self):
+        self._request('/v1/a/c', method='DELETE')
+
+        self.send_req_to_queue.assert_not_called()
+
+    def test_container_flag_changes_are_published(self):
+        self._request('/v1/a/c', method='POST',
+                      headers={'X-Container-Meta-Enqueue': 'True'})
+        self._request('/v1/a/c', method='POST',
+                      headers={'X-Remove-Container-Meta-Enqueue': 'x'})
+
+        self.assertEqual(self.send_req_to_queue.call_count, 2)
+
+    def test_account_events(self):
+        self._request('/v1/a', method='POST')
+        self.send_req_to_queue.assert_not_called()
+
+        self._request('/v1/a', method='POST',
+                      headers={'X-Account-Meta-Enqueue': 'True'})
+        self.send_req_to_queue.assert_called_once()
+
+        self.account_meta[md.META_ENQUEUE_ENABLED] = 'True'
+        self._request('/v1/a', method='POST')
+        self.assertEqual(self.send_req_to_queue.call_count, 2)
+
+        self.get_container_info.assert_not_called()
+
+    def test_object_flag_header_is_not_an_optin(self):
+        self._request('/v1/a/c/o', headers={'X-Container-Meta-Enqueue': 'x'})
+
+        self.send_req_to_queue.assert_not_called()
+
+    def test_container_rules_do_not_apply_to_container_events(self):
+        self.container_meta[md.META_ENQUEUE_ENABLED] = 'True'
+        self.container_meta['enqueue-methods'] = 'PUT'
+
+        self._request('/v1/a/c', method='DELETE')
+
+        self.send_req_to_queue.assert_called_once()
+
+    def test_non_api_urls_are_not_published(self):
+        self.account_meta[md.META_ENQUEUE_ENABLED] = 'True'
+
+        self._request('/auth/v1.0', method='POST')
+
+        self.send_req_to_queue.assert_not_called()
+
+    def test_container_message(self):
+        req = swob.Request.blank(
+            '/v1/a/c', environ={'REQUEST_METHOD': 'POST'},
+            headers={'X-Container-Meta-Enqueue': 'True',
+                     'X-Remove-Container-Meta-Color': 'x',
+                     'X-Object-Meta-Color': 'blue',
+                     'Content-Type': 'text/plain'})
+
+        message = self.app._mk_message(req)
+
+        self.assertEqual(message['type'], md.LEVEL_CONTAINER)
+        self.assertEqual(message['headers'], {
+            'X-Container-Meta-Enqueue': 'True',
+            'X-Remove-Container-Meta-Color': 'x'})
+
+    def test_account_message(self):
+        req = swob.Request.blank(
+            '/v1/a', environ={'REQUEST_METHOD': 'POST'},
+            headers={'X-Account-Meta-Enqueue': 'True',
+                     'X-Container-Meta-Color': 'x'})
+
+        message = self.app._mk_message(req)
+
+        self.assertEqual(message['type'], md.LEVEL_ACCOUNT)
+        self.assertEqual(message['headers'],
+                         {'X-Account-Meta-Enqueue': 'True'})
+
+
+class LifecycleTestCase(unittest.TestCase):
+    """
+    Pending events must be flushed, or spooled, on shutdown.
+    """
+
+    def setUp(self):
+        self.app = md.Enqueue(FakeApp(), {'shutdown_timeout': '2'})
+
+        self.flush = patch.object(self.app.publisher, 'flush',
+                                  Mock(return_value=True)).start()
+        self.spill = patch.object(self.app.publisher, 'spill',
+                                  Mock(return_value=0)).start()
+        self.signal = patch('metadata_enqueue.middleware.signal.signal',
+                            Mock(return_value='previous')).start()
+        self.atexit = patch('metadata_enqueue.middleware.atexit.register',
+                            Mock()).start()
+
+    def tearDown(self):
+        patch.stopall()
+
+    def test_shutdown_timeout_defaults_to_publish_timeout(self):
+        self.assertEqual(md.Enqueue(FakeApp(), {}).shutdown_timeout, 10.0)
+        self.assertEqual(md.Enqueue(FakeApp(), {'publish_timeout': '2'}
+                                    ).shutdown_timeout, 5.0)
+
+    def test_shutdown_flushes_within_timeout(self):
+        self.app.shutdown()
+
+        self.flush.assert_called_once_with(2.0)
+        self.spill.assert_not_called()
+
+    def test_shutdown_spills_what_could_not_be_flushed(self):
+        self.flush.return_value = False
+
+        self.app.shutdown(timeout=0)
+
+        self.flush.assert_called_once_with(0)
+        self.spill.assert_called_once()
+
+    def test_hooks_are_installed_once(self):
+        self.app._install_hooks()
+        self.app._install_hooks()
+
+        self.atexit.assert_called_once_with(self.app.shutdown)
+        self.assertEqual(self.signal.call_count, len(md.SHUTDOWN_SIGNALS))
+        for signum in md.SHUTDOWN_SIGNALS:
+            self.signal.assert_any_call(signum, self.app._on_signal)
+
+    def test_signals_are_not_handled_if_disabled(self):
+        self.app = md.Enqueue(FakeApp(), {'handle_signals': 'false'})
+
+        self.app._install_hooks()
+
+        self.atexit.assert_called_once()
+        self.signal.assert_not_called()
+
+    def test_signal_flushes_in_a_greenthread(self):
+        spawn_n = patch('metadata_enqueue.middleware.eventlet.spawn_n',
+                        Mock()).start()
+
+        self.app._on_signal(md.signal.SIGTERM, 'frame')
+
+        spawn_n.assert_called_once_with(self.app._shutdown_and_chain,
+                                        md.signal.SIGTERM, 'frame')
+
+    def test_previous_handler_is_called_after_shutdown(self):
+        previous = Mock()
+        self.app._previous_handlers[md.signal.SIGHUP] = previous
+
+        self.app._shutdown_and_chain(md.signal.SIGHUP, 'frame')
+
+        self.flush.assert_called_once()
+        previous.assert_called_once_with(md.signal.SIGHUP, 'frame')
+
+    def test_default_handler_is_restored_and_signal_raised_again(self):
+        kill = patch('metadata_enqueue.middleware.os.kill', Mock()).start()
+        self.app._previous_handlers[md.signal.SIGTERM] = md.signal.SIG_DFL
+
+        self.app._shutdown_and_chain(md.signal.SIGTERM, 'frame')
+
+        self.signal.assert_called_with(md.signal.SIGTERM, md.signal.SIG_DFL)
+        kill.assert_called_once_with(md.os.getpid(), md.signal.SIGTERM)
+
+    def test_ignored_signal_stays_ignored(self):
+        kill = patch('metadata_enqueue.middleware.os.kill', Mock()).start()
+        self.app._previous_handlers[md.signal.SIGHUP] = md.signal.SIG_IGN
+
+        self.app._shutdown_and_chain(md.signal.SIGHUP, 'frame')
+
+        kill.assert_not_called()
+
+
+class EnqueueRulesTestCase(unittest.TestCase):
+    """
+    Containers may restrict the published events with enqueue rules.
+    """
+
+    def setUp(self):
+        self.app = md.Enqueue(FakeApp(), {})
+
+        self.send_req_to_queue = patch(
+            'metadata_enqueue.middleware.Enqueue.send_req_to_queue',
+            Mock()).start()
+
+        self.meta = {md.META_ENQUEUE_ENABLED: 'True'}
+        patch('metadata_enqueue.middleware.get_container_info',
+              Mock(return_value={'meta': self.meta})).start()
+
+    def tearDown(self):
+        patch.stopall()
+
+    def _request(self, path, method='PUT', headers=None):
+        swob.Request.blank(path, environ={'REQUEST_METHOD': method},
+                           headers=headers).get_response(self.app)
+
+    def test_without_rules_every_object_is_published(self):
+        self._request('/v1/a/c/any/object')
+
+        self.send_req_to_queue.assert_called_once()
+
+    def test_name_rules(self):
+        self.meta['enqueue-names'] = 'images/*, *.pdf'
+
+        self._request('/v1/a/c/images/a.jpg')
+        self._request('/v1/a/c/docs/a.pdf')
+        self._request('/v1/a/c/docs/a.txt')
+
+        published = [c[0][0].path_info
+                     for c in self.send_req_to_queue.call_args_list]
+        self.assertEqual(published, ['/v1/a/c/images/a.jpg',
+                                     '/v1/a/c/docs/a.pdf'])
+
+    def test_method_rules(self):
+        self.meta['enqueue-methods'] = 'DELETE'
+
+        self._request('/v1/a/c/o', method='PUT')
+        self._request('/v1/a/c/o', method='DELETE')
+
+        self.send_req_to_queue.assert_called_once()
+        self.assertEqual(self.send_req_to_queue.call_args[0][0].method,
+                         'DELETE')
+
+    def test_content_type_rules(self):
+        self.meta['enqueue-content-types'] = 'image/*'
+
+        self._request('/v1/a/c/o1',
+                      headers={'Content-Type': 'image/png; q=1'})
+        self._request('/v1/a/c/o2', headers={'Content-Type': 'text/plain'})
+
+        self.send_req_to_queue.assert_called_once()
+
+    def test_content_type_is_guessed_on_put(self):
+        self.meta['enqueue-content-types'] = 'image/*'
+
+        self._request('/v1/a/c/o.png')
+        self._request('/v1/a/c/o.txt')
+
+        self.send_req_to_queue.assert_called_once()
+
+    def test_content_type_rules_do_not_apply_to_delete(self):
+        self.meta['enqueue-content-types'] = 'image/*'
+
+        self._request('/v1/a/c/o.txt', method='DELETE')
+
+        self.send_req_to_queue.assert_called_once()
+
+
 class SendToQueueTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -314,44 +754,176 @@ class SendToQueueTestCase(unittest.TestCase):
         patch('metadata_enqueue.middleware.Enqueue._mk_message',
               Mock(return_value='message')).start()
 
+        self.submit = patch.object(self.app.publisher, 'submit',
+                                   Mock(return_value=True)).start()
+        self.install_hooks = patch(
+            'metadata_enqueue.middleware.Enqueue._install_hooks',
+            Mock()).start()
+
     def tearDown(self):
         patch.stopall()
 
-    @patch('metadata_enqueue.middleware.Enqueue._publish')
-    def test_publish_works_on_first_try(self, mock_publish):
+    def test_serialized_message_is_submitted_to_publisher(self):
 
+        req = swob.Request.blank('/v1/a/c/o',
+                                 environ={'REQUEST_METHOD': 'DELETE'})
+        self.app.send_req_to_queue(req)
+
+        event = self.submit.call_args[0][0]
+        self.assertEqual(event.method, 'DELETE')
+        self.assertEqual(event.body, json.dumps('message'))
+
+    def test_lifecycle_hooks_are_installed_on_first_event(self):
         req = swob.Request.blank('/v1/a/c/o')
-        self.app.send_req_to_queue('queue', req)
+        self.app.send_req_to_queue(req)
 
-        mock_publish.called_once_with('queue', 'message')
+        self.install_hooks.assert_called_once()
 
-    @patch('metadata_enqueue.middleware.start_channel_conn')
-    @patch('metadata_enqueue.middleware.Enqueue._publish')
-    def test_publish_works_on_second_try(self, mock_pub, mock_start_q):
+    def test_event_carries_the_transaction_id(self):
+
+        req = swob.Request.blank('/v1/a/c/o',
+                                 headers={'X-Trans-Id': 'tx456'})
+        self.app.send_req_to_queue(req)
 
-        mock_start_q.return_value = 'new_queue'
-        mock_pub.side_effect = [Exception, Mock()]
+        self.assertEqual(self.submit.call_args[0][0].trans_id, 'tx456')
+
+    def test_full_buffer_does_not_raise(self):
+        self.submit.return_value = False
 
         req = swob.Request.blank('/v1/a/c/o')
-        self.app.send_req_to_queue('queue', req)
+        self.app.send_req_to_queue(req)
+
+        self.submit.assert_called_once()
 
-        mock_pub.called_with('new_queue', 'message')
+    def test_shed_event_is_logged_as_blocked(self):
+        self.submit.return_value = False
+        self.app.publisher.block()
+        self.app.logger = Mock()
+
+        req = swob.Request.blank('/v1/a/c/o')
+        self.app.send_req_to_queue(req)
+
+        self.assertIn('sink is blocked', self.app.logger.error.call_args[0])
 
     @patch('metadata_enqueue.middleware.start_channel_conn')
-    @patch('metadata_enqueue.middleware.Enqueue._publish')
-    def test_publish_fail_to_reconnect_to_queue(self, mock_pub, mock_start_q):
-        """
-        Publish fail on first try.
-        Then it trys to reconnect to queue, but fails.
-        Publish should not be called again
-        """
-        mock_start_q.return_value = None
-        mock_pub.side_effect = Exception
+    def test_connect_declares_lane_queues(self, mock_start_q):
+        conf = {'queue_name': 'name', 'lanes': 'delete, metadata',
+                'lane_delete_methods': 'DELETE',
+                'lane_delete_priority': '9'}
+        self.app = md.Enqueue(FakeApp(), conf)
+
+        self.app.publisher.connect()
+
+        topology = self.app.publisher.topology
+        mock_start_q.assert_called_with(conf, self.app.logger, topology)
+        self.assertEqual(topology.queues,
+                         [('name_delete', None), ('name_metadata', None)])
+
+
+class SinksTestCase(unittest.TestCase):
+    """
+    Each event is serialized once and handed to every sink.
+    """
+
+    def setUp(self):
+        self.conf = {
+            'queue_name': 'name',
+            'sinks': 'amqp, audit, replica',
+            'sink_audit_type': 'file',
+            'sink_audit_path': '/tmp/enqueue.log',
+            'sink_replica_type': 'amqp',
+            'sink_replica_queue_url': 'rabbitmq2',
+        }
+        self.app = md.Enqueue(FakeApp(), self.conf)
+
+        patch('metadata_enqueue.middleware.Enqueue._mk_message',
+              Mock(return_value='message')).start()
+        patch('metadata_enqueue.middleware.Enqueue._install_hooks',
+              Mock()).start()
+        self.submits = dict(
+            (name, patch.object(sink, 'submit',
+                                Mock(return_value=True)).start())
+            for name, sink in self.app.sinks.items())
+
+    def tearDown(self):
+        patch.stopall()
+
+    def test_sinks_are_built_from_conf(self):
+        self.assertEqual(list(self.app.sinks), ['amqp', 'audit', 'replica'])
+        self.assertIs(self.app.publisher, self.app.sinks['amqp'])
+        self.assertIsInstance(self.app.sinks['audit'], FileSink)
+        self.assertIsInstance(self.app.sinks['replica'], md.Publisher)
+
+        # Only the first broker records the publish histograms
+        self.assertIs(self.app.publisher.histogram,
+                      self.app.histograms['publish'])
+        self.assertIsNone(self.app.sinks['replica'].histogram)
+
+    @patch('metadata_enqueue.middleware.start_channel_conn')
+    def test_second_broker_uses_its_own_conf(self, mock_start_q):
+        self.app.sinks['replica'].connect()
+
+        conf = mock_start_q.call_args[0][0]
+        self.assertEqual(conf['queue_url'], 'rabbitmq2')
+        self.assertEqual(conf['queue_name'], 'name')
+
+    def test_brokers_may_not_share_spool_dir(self):
+        self.conf['spool_dir'] = '/tmp/spool'
+
+        with self.assertRaises(ValueError):
+            md.Enqueue(FakeApp(), self.conf)
+
+        self.conf['sink_replica_spool_dir'] = '/tmp/spool_replica'
+        md.Enqueue(FakeApp(), self.conf)
+
+    def test_same_event_is_handed_to_every_sink(self):
+        req = swob.Request.blank('/v1/a/c/o',
+                                 environ={'REQUEST_METHOD': 'PUT'})
+        self.app.send_req_to_queue(req)
+
+        events = [submit.call_args[0][0] for submit in self.submits.values()]
+        self.assertEqual(len(events), 3)
+        for event in events:
+            self.assertIs(event, events[0])
+
+    def test_full_sink_does_not_affect_others(self):
+        self.submits['audit'].return_value = False
+        self.app.logger = Mock()
 
         req = swob.Request.blank('/v1/a/c/o')
-        self.app.send_req_to_queue('queue', req)
+        self.app.send_req_to_queue(req)
+
+        for submit in self.submits.values():
+            submit.assert_called_once()
+        self.app.logger.error.assert_called_once()
+        self.assertIn('audit', self.app.logger.error.call_args[0])
+
+    def test_shutdown_flushes_every_sink(self):
+        flushes = dict(
+            (name, patch.object(sink, 'flush',
+                                Mock(return_value=name != 'audit')).start())
+            for name, sink in self.app.sinks.items())
+        spill = patch.object(self.app.sinks['audit'], 'spill',
+                             Mock(return_value=0)).start()
+
+        self.app.shutdown(timeout=1)
+
+        for flush in flushes.values():
+            flush.assert_called_once_with(1)
+        spill.assert_called_once()
+
+    def test_stats_of_every_sink(self):
+        stats = self.app.get_stats()
+
+        self.assertEqual(sorted(stats['sinks']), ['amqp', 'audit', 'replica'])
+        self.assertEqual(stats['publisher'], stats['sinks']['amqp'])
 
-        mock_pub.assert_called_once()
+    def test_sinks_without_broker(self):
+        self.conf['sinks'] = 'audit'
+        self.app = md.Enqueue(FakeApp(), self.conf)
+
+        self.assertIsNone(self.app.publisher)
+        self.assertNotIn('publisher', self.app.get_stats())
 
 
 class EnqueueHelpersTestCase(unittest.TestCase):
@@ -359,7 +931,6 @@ class EnqueueHelpersTestCase(unittest.TestCase):
     Test helpers methods:
         - _filter_headers
         - _mk_message
-        - _publish
         - _is_valid_method
         - _is_valid_object_url
         - _has_optin_header
@@ -410,47 +981,41 @@ class EnqueueHelpersTestCase(unittest.TestCase):
 
         self.assertEqual(computed, {})
 
+    @patch('metadata_enqueue.middleware.time')
     @patch('metadata_enqueue.middleware.datetime')
-    def test_mk_message_should_return_the_proper_message(self, mock_date):
+    def test_mk_message_should_return_the_proper_message(self, mock_date,
+                                                         mock_time):
         patch('metadata_enqueue.middleware.Enqueue._filter_headers',
               Mock(return_value={'header': 'value'})).start()
 
         utcnow = mock_date.utcnow.return_value
         utcnow.isoformat.return_value = '2017-02-02T16:53:33.355817'
+        mock_time.time.return_value = 1486054413.5
 
         req = swob.Request.blank(
             '/v1/a/c/o',
-            environ={'REQUEST_METHOD': 'PUT'}
+            environ={'REQUEST_METHOD': 'PUT',
+                     'swift.trans_id': 'tx123',
+                     md.ENV_ARRIVAL: 1486054413.25}
         )
 
         computed = self.app._mk_message(req)
 
         expected = {
             'uri': '/v1/a/c/o',
+            'type': 'object',
             'http_method': 'PUT',
             'headers': {'header': 'value'},
-            'timestamp': '2017-02-02T16:53:33.355817'
+            'timestamp': '2017-02-02T16:53:33.355817',
+            'trace': {
+                'trans_id': 'tx123',
+                'request_ts': 1486054413.25,
+                'enqueue_ts': 1486054413.5,
+            }
         }
 
         self.assertEqual(computed, expected)
 
-    def test_publish_should_call_queue_with_proper_args(self):
-
-        # Mock: pika.BasicProperties(delivery_mode=2)
-        patch('metadata_enqueue.middleware.pika.BasicProperties',
-              Mock(return_value={})).start()
-
-        channel = Mock()
-        message = {'body': 'random text', 'x-container': 'test'}
-        self.app._publish(channel, 'queue-name', message)
-
-        channel.basic_publish.assert_called_with(
-            exchange='',
-            routing_key='queue-name',
-            body=json.dumps(message),
-            properties={}
-        )
-
     def test_is_valid_method_should_return_true_for_valid_methods(self):
 
         for method in md.ALLOWED_METHODS:
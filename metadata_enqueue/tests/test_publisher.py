@@ -0,0 +1,738 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import eventlet
+
+from mock import patch, Mock
+from metadata_enqueue import publisher as pb
+from metadata_enqueue.spool import Spool
+
+METHODS = ('PUT', 'POST', 'DELETE')
+
+LANES_CONF = {
+    'queue_name': 'name',
+    'lanes': 'metadata, delete',
+    'lane_delete_methods': 'DELETE',
+    'lane_delete_priority': '9',
+    'lane_delete_inflight': '2',
+    'lane_metadata_methods': 'PUT',
+    'lane_metadata_priority': '1',
+    'lane_metadata_inflight': '3',
+    'buffer_size': '5',
+}
+
+PROPERTIES = {
+    'delivery_mode': 2,
+    'correlation_id': None,
+    'timestamp': 100,
+    'headers': {pb.PUBLISHED_AT_HEADER: '100.500000'},
+}
+
+
+class ParseLanesTestCase(unittest.TestCase):
+
+    def test_without_lanes_there_is_a_single_default_lane(self):
+        lanes = pb.parse_lanes({'queue_name': 'name'}, METHODS)
+
+        self.assertEqual(len(lanes), 1)
+        self.assertEqual(lanes[0].name, pb.DEFAULT_LANE)
+        self.assertEqual(lanes[0].queue, 'name')
+        self.assertEqual(lanes[0].methods, list(METHODS))
+
+    def test_lanes_are_sorted_by_priority(self):
+        lanes = pb.parse_lanes(LANES_CONF, METHODS)
+
+        self.assertEqual([lane.name for lane in lanes],
+                         ['delete', 'metadata'])
+
+    def test_queue_mode_uses_a_queue_per_lane(self):
+        lanes = pb.parse_lanes(LANES_CONF, METHODS)
+
+        self.assertEqual([lane.queue for lane in lanes],
+                         ['name_delete', 'name_metadata'])
+
+    def test_priority_mode_uses_a_single_queue(self):
+        conf = dict(LANES_CONF, lane_mode='priority')
+        lanes = pb.parse_lanes(conf, METHODS)
+
+        self.assertEqual([lane.queue for lane in lanes], ['name', 'name'])
+        self.assertEqual(pb.queue_declarations(conf, lanes),
+                         [('name', {'x-max-priority': 9})])
+
+    def test_unassigned_methods_go_to_lowest_priority_lane(self):
+        lanes = pb.parse_lanes(LANES_CONF, METHODS)
+
+        self.assertEqual(lanes[-1].methods, ['PUT', 'POST'])
+
+    def test_lane_settings_override_defaults(self):
+        delete, metadata = pb.parse_lanes(LANES_CONF, METHODS)
+
+        self.assertEqual(delete.inflight_budget, 2)
+        self.assertEqual(metadata.inflight_budget, 3)
+        self.assertEqual(delete.buffer_size, 5)
+
+    def test_invalid_lane_mode(self):
+        with self.assertRaises(ValueError):
+            pb.parse_lanes({'lane_mode': 'invalid'}, METHODS)
+
+
+class LaneTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.lane = pb.Lane('lane', ['PUT'], 'queue', buffer_size=3,
+                            inflight=2)
+
+    def test_put_drops_when_buffer_is_full(self):
+        results = [self.lane.put(i) for i in range(4)]
+
+        self.assertEqual(results, [True, True, True, False])
+        self.assertEqual(self.lane.dropped, 1)
+
+    def test_take_respects_inflight_budget(self):
+        for i in range(3):
+            self.lane.put(i)
+
+        self.assertEqual(self.lane.take(), [0, 1])
+        self.assertEqual(self.lane.take(), [])
+
+        self.lane.done(2)
+        self.assertEqual(self.lane.take(), [2])
+
+    def test_requeue_keeps_order(self):
+        for i in range(3):
+            self.lane.put(i)
+
+        events = self.lane.take()
+        self.lane.requeue(events)
+
+        self.assertEqual(list(self.lane.buffer), [0, 1, 2])
+        self.assertEqual(self.lane.inflight, 0)
+
+
+class PublisherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.channel = Mock()
+        self.connect = Mock(return_value=self.channel)
+        self.lanes = pb.parse_lanes(LANES_CONF, METHODS)
+        self.publisher = pb.Publisher(LANES_CONF, Mock(), self.lanes,
+                                      self.connect)
+
+        self.spawn = patch.object(self.publisher.pool, 'spawn_n',
+                                  Mock()).start()
+        self.worker = pb.Worker(self.publisher)
+        patch('metadata_enqueue.publisher.pika.BasicProperties',
+              Mock(side_effect=lambda **kw: kw)).start()
+        patch('metadata_enqueue.publisher.time.time',
+              Mock(return_value=100.5)).start()
+
+    def tearDown(self):
+        patch.stopall()
+
+    def published(self):
+        return [(c[1]['routing_key'], c[1]['body'])
+                for c in self.channel.basic_publish.call_args_list]
+
+    def test_submit_routes_by_method(self):
+        self.publisher.submit(pb.Event('PUT', 'put'))
+        self.publisher.submit(pb.Event('DELETE', 'delete'))
+        self.publisher.submit(pb.Event('POST', 'post'))
+
+        delete, metadata = self.lanes
+        self.assertEqual(len(delete.buffer), 1)
+        self.assertEqual(len(metadata.buffer), 2)
+
+    def test_submit_starts_the_publisher_once(self):
+        self.publisher.submit(pb.Event('PUT', 'put'))
+        self.publisher.submit(pb.Event('PUT', 'put'))
+
+        self.spawn.assert_called_once_with(self.publisher.run)
+        self.assertEqual(self.publisher.workers, 1)
+
+    def test_submit_returns_false_when_buffer_is_full(self):
+        results = [self.publisher.submit(pb.Event('PUT', 'put'))
+                   for _ in range(6)]
+
+        self.assertEqual(results, [True] * 5 + [False])
+
+    def test_urgent_events_overtake_backlog(self):
+        for i in range(5):
+            self.publisher.submit(pb.Event('PUT', 'put%d' % i))
+
+        # Publishes one batch of the metadata lane (inflight = 3)
+        self.publisher.drain(self.worker)
+
+        for i in range(2):
+            self.publisher.submit(pb.Event('DELETE', 'delete%d' % i))
+
+        while self.publisher.pending():
+            self.publisher.drain(self.worker)
+
+        self.assertEqual(self.published(), [
+            ('name_metadata', 'put0'),
+            ('name_metadata', 'put1'),
+            ('name_metadata', 'put2'),
+            ('name_delete', 'delete0'),
+            ('name_delete', 'delete1'),
+            ('name_metadata', 'put3'),
+            ('name_metadata', 'put4'),
+        ])
+
+    def test_publish_properties(self):
+        self.publisher.submit(pb.Event('PUT', 'put'))
+        self.publisher.drain(self.worker)
+
+        self.channel.basic_publish.assert_called_with(
+            exchange='',
+            routing_key='name_metadata',
+            body='put',
+            properties=PROPERTIES)
+
+    def test_trace_properties(self):
+        histogram = Mock()
+        self.publisher.buffer_histogram = histogram
+
+        self.publisher.submit(pb.Event('PUT', 'put', 'tx123', 100.25))
+        self.publisher.drain(self.worker)
+
+        properties = self.channel.basic_publish.call_args[1]['properties']
+        self.assertEqual(properties['correlation_id'], 'tx123')
+        self.assertEqual(properties['headers'],
+                         {pb.PUBLISHED_AT_HEADER: '100.500000'})
+        histogram.record.assert_called_once_with(0.25)
+
+    def test_priority_mode_sets_message_priority(self):
+        conf = dict(LANES_CONF, lane_mode='priority')
+        self.publisher = pb.Publisher(conf, Mock(),
+                                      pb.parse_lanes(conf, METHODS),
+                                      self.connect)
+        self.worker = pb.Worker(self.publisher)
+
+        self.publisher.submit(pb.Event('DELETE', 'delete'))
+        self.publisher.drain(self.worker)
+
+        self.channel.basic_publish.assert_called_with(
+            exchange='',
+            routing_key='name',
+            body='delete',
+            properties=dict(PROPERTIES, priority=9))
+
+    def test_publish_works_on_second_try(self):
+        new_channel = Mock()
+        self.connect.side_effect = [self.channel, new_channel]
+        self.channel.basic_publish.side_effect = Exception
+
+        self.publisher.submit(pb.Event('PUT', 'put'))
+
+        self.assertTrue(self.publisher.drain(self.worker))
+        new_channel.basic_publish.assert_called_once()
+        self.assertFalse(self.publisher.pending())
+
+    def test_publish_fail_to_reconnect_keeps_events(self):
+        """
+        Publish fail on first try.
+        Then it trys to reconnect to queue, but fails.
+        Publish should not be called again and events must be kept
+        """
+        self.connect.side_effect = [self.channel, None]
+        self.channel.basic_publish.side_effect = Exception
+
+        self.publisher.submit(pb.Event('PUT', 'put0'))
+        self.publisher.submit(pb.Event('PUT', 'put1'))
+
+        self.assertFalse(self.publisher.drain(self.worker))
+        self.channel.basic_publish.assert_called_once()
+
+        metadata = self.lanes[1]
+        self.assertEqual([e.body for e in metadata.buffer], ['put0', 'put1'])
+        self.assertEqual(metadata.inflight, 0)
+
+    def test_connection_errors_are_handled(self):
+        self.connect.side_effect = Exception
+
+        self.publisher.submit(pb.Event('PUT', 'put'))
+
+        self.assertFalse(self.publisher.drain(self.worker))
+        self.assertTrue(self.publisher.pending())
+
+    def test_publish_through_configured_exchange(self):
+        conf = dict(LANES_CONF, exchange='swift')
+        self.publisher = pb.Publisher(conf, Mock(), self.lanes, self.connect)
+        self.worker = pb.Worker(self.publisher)
+
+        self.publisher.submit(pb.Event('PUT', 'put'))
+        self.publisher.drain(self.worker)
+
+        self.channel.basic_publish.assert_called_with(
+            exchange='swift',
+            routing_key='name_metadata',
+            body='put',
+            properties=PROPERTIES)
+
+    def test_failed_channel_is_closed_and_topology_told(self):
+        topology = Mock()
+        self.publisher.topology = topology
+        error = Exception()
+        self.channel.basic_publish.side_effect = error
+        self.connect.side_effect = [self.channel, None]
+
+        self.publisher.submit(pb.Event('PUT', 'put'))
+        self.publisher.drain(self.worker)
+
+        self.channel.connection.close.assert_called_once()
+        topology.on_publish_error.assert_called_once_with(error)
+        self.assertIsNone(self.worker.channel)
+
+    def test_batch_is_limited_by_window(self):
+        self.publisher.window = 2
+        for i in range(3):
+            self.publisher.submit(pb.Event('PUT', 'put%d' % i))
+
+        self.publisher.drain(self.worker)
+
+        self.assertEqual(self.channel.basic_publish.call_count, 2)
+
+    def test_workers_share_the_inflight_budget(self):
+        for i in range(5):
+            self.publisher.submit(pb.Event('PUT', 'put%d' % i))
+
+        metadata = self.lanes[1]
+        metadata.take()
+
+        self.assertFalse(self.publisher.ready())
+        self.assertTrue(self.publisher.pending())
+
+    def test_transactional_batch_is_committed_once(self):
+        conf = dict(LANES_CONF, publish_transactional='true')
+        self.publisher = pb.Publisher(conf, Mock(), self.lanes, self.connect)
+        worker = pb.Worker(self.publisher)
+
+        for i in range(3):
+            self.publisher.submit(pb.Event('PUT', 'put%d' % i))
+        self.publisher.drain(worker)
+
+        self.channel.tx_select.assert_called_once()
+        self.channel.tx_commit.assert_called_once()
+        self.assertEqual(self.channel.basic_publish.call_count, 3)
+
+    def test_failed_batch_is_published_again(self):
+        new_channel = Mock()
+        self.connect.side_effect = [self.channel, new_channel]
+        self.channel.basic_publish.side_effect = [None, Exception]
+
+        for i in range(3):
+            self.publisher.submit(pb.Event('PUT', 'put%d' % i))
+
+        self.assertTrue(self.publisher.drain(self.worker))
+        self.assertEqual(new_channel.basic_publish.call_count, 3)
+
+
+class PublisherScalingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        conf = dict(LANES_CONF, buffer_size='100', publisher_scale_depth='10',
+                    publisher_max_workers='3')
+        self.publisher = pb.Publisher(conf, Mock(),
+                                      pb.parse_lanes(conf, METHODS), Mock())
+        self.spawn = patch.object(self.publisher.pool, 'spawn_n',
+                                  Mock()).start()
+
+    def tearDown(self):
+        patch.stopall()
+
+    def test_pool_grows_with_buffer_depth(self):
+        for i in range(25):
+            self.publisher.submit(pb.Event('PUT', 'put'))
+
+        self.assertEqual(self.publisher.workers, 3)
+
+        for i in range(50):
+            self.publisher.submit(pb.Event('PUT', 'put'))
+
+        self.assertEqual(self.publisher.workers, 3)
+        self.assertEqual(self.spawn.call_count, 3)
+
+    def test_idle_extra_workers_exit(self):
+        self.publisher.idle_timeout = 0
+        self.publisher.workers = 2
+
+        self.publisher.run()
+
+        self.assertEqual(self.publisher.workers, 1)
+
+    def test_full_pool_does_not_block_submit(self):
+        # Retired workers still closing their connections
+        patch.object(self.publisher.pool, 'free', Mock(return_value=0)
+                     ).start()
+
+        for i in range(25):
+            self.assertTrue(self.publisher.submit(pb.Event('PUT', 'put')))
+
+        self.spawn.assert_not_called()
+
+    def test_close_is_bounded_by_publish_timeout(self):
+        self.publisher.publish_timeout = 0.01
+        worker = pb.Worker(self.publisher)
+        worker.channel = Mock()
+        worker.channel.connection.close.side_effect = \
+            lambda: eventlet.sleep(1)
+
+        start = time.time()
+        worker.close()
+
+        self.assertLess(time.time() - start, 0.5)
+        self.assertIsNone(worker.channel)
+
+    @patch.object(pb, 'Worker')
+    def test_extra_workers_retire_when_buffer_shrinks(self, mock_worker):
+        mock_worker.return_value.send.return_value = True
+        self.publisher.workers = 3
+        for i in range(5):
+            self.publisher.lanes[1].put(pb.Event('PUT', 'put'))
+        self.publisher._ring()
+
+        # Retires after one batch, without waiting for the idle timeout
+        self.publisher.run()
+
+        self.assertEqual(self.publisher.workers, 2)
+        mock_worker.return_value.send.assert_called_once()
+
+
+class PublisherGreenthreadsTestCase(unittest.TestCase):
+
+    def test_events_are_published_in_background(self):
+        channel = Mock()
+        conf = dict(LANES_CONF, publisher_idle_timeout='0.01')
+        publisher = pb.Publisher(conf, Mock(), pb.parse_lanes(conf, METHODS),
+                                 Mock(return_value=channel))
+
+        for i in range(5):
+            publisher.submit(pb.Event('PUT', 'put%d' % i))
+        publisher.submit(pb.Event('DELETE', 'delete'))
+
+        for _ in range(10):
+            eventlet.sleep(0)
+
+        self.assertFalse(publisher.pending())
+        self.assertEqual(channel.basic_publish.call_count, 6)
+
+
+class PublisherShutdownTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.spool = Spool(self.path, Mock())
+        self.channel = Mock()
+        self.publisher = self._publisher()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        patch.stopall()
+
+    def _publisher(self, connect=None):
+        conf = dict(LANES_CONF, publisher_idle_timeout='0.01',
+                    retry_interval='0.01')
+        return pb.Publisher(conf, Mock(), pb.parse_lanes(conf, METHODS),
+                            connect or Mock(return_value=self.channel),
+                            spool=self.spool)
+
+    def test_flush_publishes_buffered_events(self):
+        for i in range(3):
+            self.publisher.submit(pb.Event('PUT', 'put%d' % i))
+
+        self.assertTrue(self.publisher.flush(1))
+        self.assertEqual(self.channel.basic_publish.call_count, 3)
+
+    def test_flush_gives_up_after_timeout(self):
+        self.publisher = self._publisher(connect=Mock(return_value=None))
+        self.publisher.submit(pb.Event('PUT', 'put'))
+
+        self.assertFalse(self.publisher.flush(0.05))
+        self.assertTrue(self.publisher.pending())
+
+    def test_spill_and_replay(self):
+        self.publisher = self._publisher(connect=Mock(return_value=None))
+        patch.object(self.publisher.pool, 'spawn_n').start()
+        self.publisher.submit(pb.Event('PUT', 'put'))
+        self.publisher.submit(pb.Event('DELETE', 'delete'))
+
+        self.assertEqual(self.publisher.spill(), 2)
+        self.assertFalse(self.publisher.pending())
+
+        # A new process publishes the spooled events
+        publisher = self._publisher()
+        publisher.submit(pb.Event('PUT', 'new'))
+
+        self.assertTrue(publisher.flush(1))
+        bodies = [c[1]['body']
+                  for c in self.channel.basic_publish.call_args_list]
+        self.assertEqual(sorted(bodies), ['delete', 'new', 'put'])
+        self.assertEqual(self.spool.claim(), [])
+
+    def test_spill_includes_batches_being_published(self):
+        patch.object(self.publisher.pool, 'spawn_n').start()
+        self.publisher.submit(pb.Event('PUT', 'put'))
+        self.publisher.submit(pb.Event('DELETE', 'delete'))
+        worker = Mock()
+
+        def send(lane, events):
+            # Shutdown while the batch is being published
+            self.assertEqual(self.publisher.spill(), 2)
+            return True
+        worker.send.side_effect = send
+
+        self.assertTrue(self.publisher.drain(worker))
+        self.assertEqual(self.publisher.batches, [])
+
+        claimed = self.spool.claim()
+        self.assertEqual(len(claimed), 1)
+        self.assertEqual(sorted(r['body'] for r in self.spool.read(
+            claimed[0])), ['delete', 'put'])
+
+    def test_spill_without_spool_loses_events(self):
+        self.publisher.spool = None
+        self.publisher.lanes[0].put(pb.Event('DELETE', 'delete'))
+
+        self.assertEqual(self.publisher.spill(), 0)
+        self.assertFalse(self.publisher.pending())
+        self.publisher.logger.error.assert_called_once()
+
+    def test_replay_spools_again_what_does_not_fit(self):
+        events = [pb.Event('PUT', 'put%d' % i) for i in range(7)]
+        self.spool.write(events)
+
+        self.assertEqual(self.publisher.replay(), 5)
+
+        claimed = self.spool.claim()
+        self.assertEqual(len(claimed), 1)
+        self.assertEqual([r['body'] for r in self.spool.read(claimed[0])],
+                         ['put5', 'put6'])
+
+    def test_submit_does_not_replay(self):
+        patch.object(self.publisher.pool, 'spawn_n').start()
+        self.spool.write([pb.Event('PUT', 'spooled')])
+
+        self.publisher.submit(pb.Event('PUT', 'put'))
+
+        self.assertEqual(len(self.publisher.lanes[1].buffer), 1)
+        self.assertEqual(len(self.spool.claim()), 1)
+
+    def test_replay_skips_invalid_records(self):
+        with open(os.path.join(self.path, 'enqueue-1.spool'), 'w') as fd:
+            fd.write(json.dumps({'method': 'PUT', 'body': 'b', 'x': 1}))
+            fd.write('\n')
+            fd.write(json.dumps({'method': 'PUT', 'body': 'put'}))
+            fd.write('\n')
+
+        self.assertEqual(self.publisher.replay(), 1)
+        self.publisher.logger.error.assert_called_once()
+
+    def test_replay_logs_spool_errors(self):
+        self.spool.write([pb.Event('PUT', 'put')])
+
+        with patch.object(self.spool, 'read', side_effect=IOError()):
+            self.assertEqual(self.publisher.replay(), 0)
+
+        self.publisher.logger.exception.assert_called_once()
+
+    def test_workers_rescan_the_spool(self):
+        self.publisher = self._publisher()
+        self.publisher.replay_interval = 0.01
+        self.publisher.submit(pb.Event('PUT', 'put'))
+        self.assertTrue(self.publisher.flush(1))
+
+        # Spooled by another process after the first scan
+        self.spool.write([pb.Event('DELETE', 'delete')])
+        for _ in range(10):
+            eventlet.sleep(0.01)
+
+        bodies = [c[1]['body']
+                  for c in self.channel.basic_publish.call_args_list]
+        self.assertEqual(sorted(bodies), ['delete', 'put'])
+
+
+class PublisherFlowControlTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.spool = Spool(self.path, Mock())
+        self.channel = Mock()
+        self.publisher = self._publisher()
+        self.worker = pb.Worker(self.publisher)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        patch.stopall()
+
+    def _publisher(self, spool=True, **extra):
+        conf = dict(LANES_CONF, publisher_idle_timeout='0.01',
+                    retry_interval='0.01', **extra)
+        publisher = pb.Publisher(conf, Mock(), pb.parse_lanes(conf, METHODS),
+                                 Mock(return_value=self.channel),
+                                 spool=self.spool if spool else None)
+        patch.object(publisher.pool, 'spawn_n').start()
+
+        return publisher
+
+    def _wait_spill(self):
+        for _ in range(100):
+            if not self.publisher._spilling:
+                return
+            eventlet.sleep(0.01)
+
+    def test_flow_control_default(self):
+        self.assertEqual(self.publisher.flow_control, pb.FLOW_CONTROL_SPOOL)
+        self.assertEqual(self._publisher(spool=False).flow_control,
+                         pb.FLOW_CONTROL_SHED)
+
+    def test_invalid_flow_control(self):
+        with self.assertRaises(ValueError):
+            self._publisher(flow_control='wait')
+
+        with self.assertRaises(ValueError):
+            self._publisher(spool=False, flow_control='spool')
+
+    def test_connect_subscribes_to_blocked_notifications(self):
+        channel = self.worker.connect()
+        connection = channel.connection
+
+        connection.add_on_connection_blocked_callback.assert_called_once_with(
+            self.worker._on_blocked)
+        connection.add_on_connection_unblocked_callback.\
+            assert_called_once_with(self.worker._on_unblocked)
+
+    def test_blocked_and_unblocked(self):
+        self.worker._on_blocked(Mock(), Mock())
+        self.assertTrue(self.publisher.blocked)
+        self.assertTrue(self.publisher.to_dict()['blocked'])
+
+        self.publisher.submit(pb.Event('PUT', 'put'))
+        self.assertFalse(self.publisher.ready())
+
+        self.worker._on_unblocked(Mock(), Mock())
+        self.assertFalse(self.publisher.blocked)
+        self.assertTrue(self.publisher.ready())
+
+    def test_blocked_expires_after_backoff(self):
+        self.publisher = self._publisher(blocked_backoff='0.01')
+        self.publisher.block()
+        self.assertTrue(self.publisher.blocked)
+
+        eventlet.sleep(0.02)
+        self.assertFalse(self.publisher.blocked)
+
+    def test_close_keeps_blocked_state(self):
+        self.worker.channel = self.worker.connect()
+        self.worker._on_blocked(Mock())
+
+        self.worker.close()
+        self.assertTrue(self.publisher.blocked)
+
+    def test_poll_reads_notifications(self):
+        self.worker.channel = self.channel
+
+        self.worker.poll(0.5)
+        self.channel.connection.process_data_events.assert_called_once_with(
+            time_limit=0.5)
+
+    def test_poll_closes_lost_connection(self):
+        self.worker.channel = self.channel
+        self.worker._on_blocked()
+        self.channel.connection.process_data_events.side_effect = \
+            Exception('closed')
+
+        self.worker.poll(0.5)
+        self.assertIsNone(self.worker.channel)
+        self.assertTrue(self.publisher.blocked)
+
+    def test_shed_drops_events_while_blocked(self):
+        self.publisher = self._publisher(flow_control='shed')
+        self.publisher.block()
+
+        self.assertFalse(self.publisher.submit(pb.Event('PUT', 'put')))
+        self.assertFalse(self.publisher.pending())
+        self.assertEqual(self.publisher.lanes[1].shed, 1)
+        self.assertEqual(self.publisher.lanes[1].dropped, 0)
+
+    def test_spool_moves_full_buffer_to_disk_while_blocked(self):
+        self.publisher.block()
+
+        for i in range(7):
+            self.assertTrue(
+                self.publisher.submit(pb.Event('PUT', 'put%d' % i)))
+
+        lane = self.publisher.lanes[1]
+        self.assertEqual([e.body for e in lane.buffer], ['put5', 'put6'])
+        self.assertEqual(lane.dropped, 0)
+
+        # Written in background, not in the request
+        self.assertEqual(self.spool.claim(), [])
+        self._wait_spill()
+
+        claimed = self.spool.claim()
+        self.assertEqual(len(claimed), 1)
+        self.assertEqual(len(self.spool.read(claimed[0])), 5)
+
+    def test_full_buffer_drops_events_while_spilling(self):
+        self.publisher.block()
+
+        with patch.object(pb.eventlet, 'spawn_n') as mock_spawn:
+            for i in range(11):
+                self.publisher.submit(pb.Event('PUT', 'put%d' % i))
+
+        mock_spawn.assert_called_once()
+        self.assertEqual(self.publisher.lanes[1].dropped, 1)
+
+    def test_full_buffer_drops_events_when_not_blocked(self):
+        for i in range(6):
+            self.publisher.submit(pb.Event('PUT', 'put%d' % i))
+
+        self.assertEqual(self.publisher.lanes[1].dropped, 1)
+        self.assertEqual(self.spool.claim(), [])
+
+    def test_publish_timeout_blocks_without_retrying(self):
+        self.publisher = self._publisher(publish_timeout='0.01')
+        worker = pb.Worker(self.publisher)
+        self.channel.basic_publish.side_effect = \
+            lambda **kwargs: eventlet.sleep(1)
+
+        self.assertFalse(worker.send(self.publisher.lanes[1],
+                                     [pb.Event('PUT', 'put')]))
+        self.assertEqual(self.channel.basic_publish.call_count, 1)
+        self.assertIsNone(worker.channel)
+        self.assertTrue(self.publisher.blocked)
+        self.assertFalse(self.publisher.ready())
+
+    def test_publish_timeout_disabled(self):
+        self.assertIsNone(self._publisher(publish_timeout='0').publish_timeout)
+
+    def test_run_publishes_spooled_events_once_unblocked(self):
+        self.publisher.block()
+        for i in range(6):
+            self.publisher.submit(pb.Event('PUT', 'put%d' % i))
+        self._wait_spill()
+
+        self.channel.connection.process_data_events.side_effect = \
+            lambda time_limit: self.publisher.unblock()
+
+        worker = pb.Worker(self.publisher)
+        worker.channel = self.channel
+        with patch.object(pb, 'Worker', return_value=worker):
+            thread = eventlet.spawn(self.publisher.run)
+            for _ in range(10):
+                eventlet.sleep(0)
+            thread.kill()
+
+        self.assertFalse(self.publisher.pending())
+        bodies = [c[1]['body']
+                  for c in self.channel.basic_publish.call_args_list]
+
+        # What did not fit in the buffer waits in the spool
+        for path in self.spool.claim():
+            bodies.extend(r['body'] for r in self.spool.read(path))
+
+        self.assertEqual(sorted(bodies), ['put%d' % i for i in range(6)])
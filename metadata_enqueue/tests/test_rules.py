@@ -0,0 +1,78 @@
+import unittest
+
+from metadata_enqueue import rules as rl
+
+
+class CompileGlobsTestCase(unittest.TestCase):
+
+    def test_empty_value(self):
+        self.assertIsNone(rl.compile_globs(None))
+        self.assertIsNone(rl.compile_globs(''))
+
+    def test_prefix_and_suffix(self):
+        regex = rl.compile_globs('images/*, *.pdf')
+
+        self.assertTrue(regex.match('images/a/b.jpg'))
+        self.assertTrue(regex.match('docs/a.pdf'))
+        self.assertFalse(regex.match('docs/a.pdf.txt'))
+        self.assertFalse(regex.match('other/images/a.jpg'))
+
+
+class RulesTestCase(unittest.TestCase):
+
+    def test_empty_rules_match_everything(self):
+        self.assertTrue(rl.Rules().match('PUT', 'o', 'text/plain'))
+
+    def test_methods(self):
+        rules = rl.Rules(methods='put, delete')
+
+        self.assertTrue(rules.match('PUT', 'o'))
+        self.assertTrue(rules.match('DELETE', 'o'))
+        self.assertFalse(rules.match('POST', 'o'))
+
+    def test_every_rule_must_match(self):
+        rules = rl.Rules(names='*.jpg', content_types='image/*')
+
+        self.assertTrue(rules.match('PUT', 'a.jpg', 'image/jpeg'))
+        self.assertFalse(rules.match('PUT', 'a.jpg', 'text/plain'))
+        self.assertFalse(rules.match('PUT', 'a.txt', 'image/jpeg'))
+
+    def test_content_type_rules_skipped_without_content_type(self):
+        rules = rl.Rules(content_types='image/*')
+
+        self.assertTrue(rules.match('DELETE', 'a.txt', None))
+
+
+class RulesCacheTestCase(unittest.TestCase):
+
+    def test_container_without_rules(self):
+        cache = rl.RulesCache()
+
+        self.assertIsNone(cache.get({'enqueue': 'True'}))
+
+    def test_rules_are_compiled_once(self):
+        cache = rl.RulesCache()
+        meta = {rl.META_RULE_NAMES: '*.jpg'}
+
+        rules = cache.get(meta)
+
+        self.assertIs(cache.get(dict(meta)), rules)
+
+    def test_changed_metadata_compiles_new_rules(self):
+        cache = rl.RulesCache()
+
+        rules = cache.get({rl.META_RULE_NAMES: '*.jpg'})
+
+        self.assertIsNot(cache.get({rl.META_RULE_NAMES: '*.png'}), rules)
+
+    def test_least_recently_used_is_evicted(self):
+        cache = rl.RulesCache(size=2)
+
+        first = cache.get({rl.META_RULE_NAMES: 'a'})
+        cache.get({rl.META_RULE_NAMES: 'b'})
+        cache.get({rl.META_RULE_NAMES: 'a'})
+        cache.get({rl.META_RULE_NAMES: 'c'})
+
+        self.assertIs(cache.get({rl.META_RULE_NAMES: 'a'}), first)
+        self.assertEqual(len(cache._cache), 2)
+        self.assertNotIn(('b', None, None), cache._cache)
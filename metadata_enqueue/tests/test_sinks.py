@@ -0,0 +1,243 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import eventlet
+
+from eventlet.green import socket
+from mock import patch, Mock
+from metadata_enqueue.publisher import Event
+from metadata_enqueue import sinks as sk
+
+
+class FakeSink(sk.Sink):
+
+    def __init__(self, name, conf, logger):
+        super(FakeSink, self).__init__(name, conf, logger)
+        self.written = []
+        self.write_error = None
+        self.delay = 0
+
+    def write(self, events):
+        if self.delay:
+            eventlet.sleep(self.delay)
+        if self.write_error:
+            raise self.write_error
+        self.written.extend(events)
+
+
+def settle():
+    for _ in range(10):
+        eventlet.sleep(0)
+
+
+class ParseSinksTestCase(unittest.TestCase):
+
+    def test_default_is_a_single_broker(self):
+        conf = {'queue_name': 'name'}
+
+        self.assertEqual(sk.parse_sinks(conf), [('amqp', 'amqp', conf)])
+
+    def test_sink_options_override_filter_options(self):
+        conf = {
+            'queue_url': 'rabbitmq',
+            'buffer_size': '10',
+            'sinks': 'amqp, audit, replica',
+            'sink_audit_type': 'file',
+            'sink_audit_path': '/tmp/audit.log',
+            'sink_replica_type': 'amqp',
+            'sink_replica_queue_url': 'rabbitmq2',
+        }
+
+        sinks = sk.parse_sinks(conf)
+
+        self.assertEqual([(name, sink_type) for name, sink_type, _ in sinks],
+                         [('amqp', 'amqp'), ('audit', 'file'),
+                          ('replica', 'amqp')])
+        self.assertEqual(sinks[0][2]['queue_url'], 'rabbitmq')
+        self.assertEqual(sinks[1][2]['path'], '/tmp/audit.log')
+        self.assertEqual(sinks[1][2]['buffer_size'], '10')
+        self.assertEqual(sinks[2][2]['queue_url'], 'rabbitmq2')
+
+    def test_load_sink(self):
+        self.assertIs(sk.load_sink('file'), sk.FileSink)
+        self.assertIs(sk.load_sink('unix'), sk.UnixSocketSink)
+        self.assertIs(
+            sk.load_sink('metadata_enqueue.tests.test_sinks:FakeSink'),
+            FakeSink)
+
+    def test_load_invalid_sink(self):
+        for sink_type in ('kafka', 'metadata_enqueue.sinks:Missing',
+                          'missing.module:Sink'):
+            with self.assertRaises(ValueError):
+                sk.load_sink(sink_type)
+
+
+class SinkTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sink = FakeSink('fake', {'buffer_size': '3',
+                                      'publish_window': '2',
+                                      'retry_interval': '0.01'}, Mock())
+
+    def test_events_are_written_in_background(self):
+        events = [Event('PUT', 'put%d' % i) for i in range(3)]
+        for event in events:
+            self.assertTrue(self.sink.submit(event))
+
+        self.assertEqual(self.sink.written, [])
+        settle()
+
+        self.assertEqual(self.sink.written, events)
+        self.assertFalse(self.sink.busy())
+
+    def test_full_buffer_drops_events(self):
+        for i in range(4):
+            self.sink.submit(Event('PUT', 'put%d' % i))
+
+        self.assertEqual(self.sink.to_dict()['dropped'], 1)
+
+    def test_failed_batch_is_written_again(self):
+        self.sink.write_error = IOError()
+        self.sink.submit(Event('PUT', 'put'))
+        settle()
+
+        self.assertTrue(self.sink.blocked)
+        self.assertEqual(self.sink.errors, 1)
+        self.assertTrue(self.sink.busy())
+
+        self.sink.write_error = None
+        self.assertTrue(self.sink.flush(1))
+        self.assertFalse(self.sink.blocked)
+        self.assertEqual([e.body for e in self.sink.written], ['put'])
+
+    def test_slow_batch_times_out(self):
+        self.sink.timeout = 0.01
+        self.sink.delay = 1
+        self.sink.submit(Event('PUT', 'put'))
+
+        eventlet.sleep(0.05)
+
+        self.assertTrue(self.sink.blocked)
+        self.assertEqual(self.sink.written, [])
+        self.sink.delay = 0
+        self.assertTrue(self.sink.flush(1))
+
+    def test_slow_sink_does_not_block_others(self):
+        slow = FakeSink('slow', {}, Mock())
+        slow.delay = 1
+        event = Event('PUT', 'put')
+
+        slow.submit(event)
+        self.sink.submit(event)
+
+        self.assertTrue(self.sink.flush(0.5))
+        self.assertIs(self.sink.written[0], event)
+        self.assertTrue(slow.busy())
+
+    def test_spill_drops_buffered_events(self):
+        self.sink.write_error = IOError()
+        self.sink.submit(Event('PUT', 'put'))
+        settle()
+
+        self.sink.lane.inflight = 1
+        self.assertEqual(self.sink.spill(), 0)
+        self.sink.logger.error.assert_called_once()
+        self.assertEqual(self.sink.logger.error.call_args[0][1], 2)
+        self.assertEqual(self.sink.to_dict()['buffered'], 0)
+
+
+class FileSinkTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.conf = {'path': os.path.join(self.path, 'enqueue.log')}
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_path_is_required(self):
+        with self.assertRaises(ValueError):
+            sk.FileSink('audit', {}, Mock())
+
+    def test_writes_are_not_interrupted(self):
+        conf = dict(self.conf, publish_timeout='0.01')
+        sink = sk.FileSink('audit', conf, Mock())
+
+        with patch.object(sk.tpool, 'execute',
+                          side_effect=lambda func, data: eventlet.sleep(0.05)):
+            sink.submit(Event('PUT', 'put'))
+            self.assertTrue(sink.flush(1))
+
+        self.assertFalse(sink.blocked)
+        self.assertEqual(sink.errors, 0)
+
+    @patch('metadata_enqueue.sinks.os.fsync')
+    def test_events_are_appended(self, mock_fsync):
+        with open(self.conf['path'], 'w') as fd:
+            fd.write('old\n')
+
+        sink = sk.FileSink('audit', dict(self.conf, fsync='true'), Mock())
+        sink.submit(Event('PUT', '{"a": 1}'))
+        sink.submit(Event('DELETE', '{"b": 2}'))
+        self.assertTrue(sink.flush(1))
+
+        with open(self.conf['path']) as fd:
+            self.assertEqual(fd.read(), 'old\n{"a": 1}\n{"b": 2}\n')
+        mock_fsync.assert_called()
+
+
+class UnixSocketSinkTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.conf = {'path': os.path.join(self.path, 'enqueue.sock'),
+                     'retry_interval': '0.01'}
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _listen(self):
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.conf['path'])
+        server.listen(1)
+        return server
+
+    def test_path_is_required(self):
+        with self.assertRaises(ValueError):
+            sk.UnixSocketSink('indexer', {}, Mock())
+
+    def test_events_are_streamed(self):
+        server = self._listen()
+        sink = sk.UnixSocketSink('indexer', self.conf, Mock())
+
+        sink.submit(Event('PUT', '{"a": 1}'))
+        sink.submit(Event('PUT', '{"b": 2}'))
+        conn, _ = server.accept()
+        self.assertTrue(sink.flush(1))
+        sink.close()
+
+        data = b''
+        while True:
+            chunk = conn.recv(1024)
+            if not chunk:
+                break
+            data += chunk
+        conn.close()
+        server.close()
+
+        self.assertEqual(data, b'{"a": 1}\n{"b": 2}\n')
+
+    def test_events_wait_for_the_consumer(self):
+        sink = sk.UnixSocketSink('indexer', self.conf, Mock())
+        sink.submit(Event('PUT', 'put'))
+        settle()
+
+        self.assertTrue(sink.blocked)
+        self.assertIsNone(sink.sock)
+
+        server = self._listen()
+        self.assertTrue(sink.flush(1))
+        sink.close()
+        server.close()
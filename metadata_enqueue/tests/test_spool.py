@@ -0,0 +1,82 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import Mock
+from metadata_enqueue.publisher import Event
+from metadata_enqueue import spool as sp
+
+
+def pairs(records):
+    return [(record['method'], record['body']) for record in records]
+
+
+class SpoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.spool = sp.Spool(os.path.join(self.path, 'spool'), Mock())
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_claim_without_directory(self):
+        self.assertEqual(self.spool.claim(), [])
+
+    def test_write_nothing(self):
+        self.assertEqual(self.spool.write([]), 0)
+        self.assertFalse(os.path.exists(self.spool.path))
+
+    def test_write_and_read(self):
+        events = [Event('PUT', '{"uri": "/v1/a/c/o"}', 'tx1', 10.5),
+                  Event('DELETE', 'x')]
+
+        self.assertEqual(self.spool.write(events), 2)
+
+        claimed = self.spool.claim()
+        self.assertEqual(len(claimed), 1)
+
+        records = self.spool.read(claimed[0])
+        self.assertEqual(records[0], {'method': 'PUT',
+                                      'body': '{"uri": "/v1/a/c/o"}',
+                                      'trans_id': 'tx1',
+                                      'enqueued_at': 10.5})
+        self.assertEqual(pairs(records), [
+            ('PUT', '{"uri": "/v1/a/c/o"}'), ('DELETE', 'x')])
+
+    def test_files_are_claimed_once_oldest_first(self):
+        self.spool.write([Event('PUT', 'first')])
+        self.spool.write([Event('PUT', 'second')])
+
+        claimed = self.spool.claim()
+
+        self.assertEqual([pairs(self.spool.read(path)) for path in claimed],
+                         [[('PUT', 'first')], [('PUT', 'second')]])
+        self.assertEqual(self.spool.claim(), [])
+
+    def test_incomplete_files_are_not_claimed(self):
+        os.makedirs(self.spool.path)
+        with open(os.path.join(self.spool.path, '.enqueue-1'), 'w') as fd:
+            fd.write('{"method": "PUT", "body": "x"}\n')
+
+        self.assertEqual(self.spool.claim(), [])
+
+    def test_invalid_records_are_skipped(self):
+        self.spool.write([Event('PUT', 'valid')])
+        path = self.spool.claim()[0]
+        with open(path, 'a') as fd:
+            fd.write('not json\n')
+            fd.write('{"body": "no method"}\n')
+
+        self.assertEqual(pairs(self.spool.read(path)), [('PUT', 'valid')])
+        self.assertEqual(self.spool.logger.error.call_count, 2)
+
+    def test_remove(self):
+        self.spool.write([Event('PUT', 'x')])
+        path = self.spool.claim()[0]
+
+        self.spool.remove(path)
+        self.spool.remove(path)
+
+        self.assertEqual(os.listdir(self.spool.path), [])
@@ -0,0 +1,113 @@
+import os
+import pstats
+import tempfile
+import unittest
+
+from metadata_enqueue.stats import Histogram, SamplingProfiler
+
+
+class HistogramTestCase(unittest.TestCase):
+
+    def test_empty_histogram(self):
+        computed = Histogram().to_dict()
+
+        self.assertEqual(computed['count'], 0)
+        self.assertEqual(computed['p99_us'], 0)
+
+    def test_small_values_are_exact(self):
+        histogram = Histogram()
+        for value in range(1, 11):
+            histogram.record(value / 1000000.0)
+
+        self.assertEqual(histogram.percentile(50), 5)
+        self.assertEqual(histogram.percentile(100), 10)
+        self.assertEqual(histogram.min, 1)
+        self.assertEqual(histogram.max, 10)
+
+    def test_big_values_have_bounded_relative_error(self):
+        histogram = Histogram(precision=5)
+        histogram.record(1.234567)
+
+        computed = histogram.percentile(50)
+
+        self.assertLessEqual(computed, 1234567)
+        self.assertGreater(computed, 1234567 * (1 - 1 / 16.0))
+
+    def test_memory_is_bounded(self):
+        histogram = Histogram(precision=5)
+        for value in range(100000):
+            histogram.record(value / 1000000.0)
+
+        self.assertEqual(histogram.count, 100000)
+        self.assertLess(len(histogram.counts), 32 * 17)
+
+    def test_time_records_elapsed_time(self):
+        histogram = Histogram()
+        with histogram.time():
+            pass
+
+        self.assertEqual(histogram.count, 1)
+
+    def test_to_dict_keys(self):
+        histogram = Histogram()
+        histogram.record(0.001)
+
+        computed = histogram.to_dict()
+
+        for key in ('count', 'min_us', 'max_us', 'mean_us', 'p50_us',
+                    'p90_us', 'p99_us', 'p999_us'):
+            self.assertIn(key, computed)
+        self.assertEqual(computed['mean_us'], 1000)
+
+
+class SamplingProfilerTestCase(unittest.TestCase):
+
+    def test_disabled_profiler_never_samples(self):
+        profiler = SamplingProfiler()
+
+        self.assertFalse(any(profiler.should_sample() for _ in range(10)))
+
+    def test_samples_one_in_n(self):
+        profiler = SamplingProfiler(sample_rate=3)
+
+        computed = [profiler.should_sample() for _ in range(9)]
+
+        self.assertEqual(computed.count(True), 3)
+
+    def test_run_returns_result_and_aggregates(self):
+        profiler = SamplingProfiler(sample_rate=1)
+
+        self.assertEqual(profiler.run(sum, [1, 2]), 3)
+        profiler.run(sum, [3])
+
+        self.assertEqual(profiler.profiled, 2)
+        self.assertIn('function calls', profiler.report())
+
+    def test_overlapping_samples_are_skipped(self):
+        profiler = SamplingProfiler(sample_rate=1)
+
+        def nested():
+            self.assertFalse(profiler.should_sample())
+
+        self.assertTrue(profiler.should_sample())
+        profiler.run(nested)
+
+        self.assertEqual(profiler.profiled, 1)
+        self.assertEqual(profiler.skipped, 1)
+        self.assertTrue(profiler.should_sample())
+
+    def test_dump_on_demand(self):
+        path = tempfile.mktemp()
+        profiler = SamplingProfiler(sample_rate=1, dump_path=path)
+
+        profiler.run(sum, [1, 2])
+        self.assertFalse(os.path.exists(path))
+
+        profiler.dump()
+        try:
+            self.assertIn('sum', str(pstats.Stats(path).stats))
+        finally:
+            os.unlink(path)
+
+    def test_report_is_empty_without_samples(self):
+        self.assertEqual(SamplingProfiler().report(), '')
@@ -0,0 +1,109 @@
+import unittest
+
+import pika
+
+from mock import Mock, call
+from metadata_enqueue import topology as tp
+
+
+class QueueArgumentsTestCase(unittest.TestCase):
+
+    def test_no_arguments_by_default(self):
+        self.assertEqual(tp.queue_arguments({}), {})
+
+    def test_arguments_from_conf(self):
+        conf = {
+            'queue_mode': 'lazy',
+            'queue_max_length': '1000',
+            'queue_max_length_bytes': '2000',
+            'queue_overflow': 'reject-publish-dlx',
+            'queue_message_ttl': '60000',
+            'queue_dead_letter_exchange': 'dlx',
+            'queue_dead_letter_routing_key': 'dead',
+        }
+
+        computed = tp.queue_arguments(conf)
+
+        self.assertEqual(computed, {
+            'x-queue-mode': 'lazy',
+            'x-max-length': 1000,
+            'x-max-length-bytes': 2000,
+            'x-overflow': 'reject-publish-dlx',
+            'x-message-ttl': 60000,
+            'x-dead-letter-exchange': 'dlx',
+            'x-dead-letter-routing-key': 'dead',
+        })
+
+    def test_invalid_overflow(self):
+        with self.assertRaises(ValueError):
+            tp.queue_arguments({'queue_overflow': 'invalid'})
+
+    def test_invalid_length(self):
+        with self.assertRaises(ValueError):
+            tp.queue_arguments({'queue_max_length': 'many'})
+
+
+class TopologyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.channel = Mock()
+
+    def test_default_exchange_declares_only_queues(self):
+        topology = tp.Topology({}, [('a', None), ('b', None)])
+
+        topology.declare(self.channel)
+
+        self.channel.exchange_declare.assert_not_called()
+        self.channel.queue_bind.assert_not_called()
+        self.assertEqual(self.channel.queue_declare.call_args_list, [
+            call(queue='a', durable=True),
+            call(queue='b', durable=True),
+        ])
+
+    def test_named_exchange_is_declared_and_bound(self):
+        conf = {'exchange': 'swift', 'exchange_type': 'topic'}
+        topology = tp.Topology(conf, [('a', None)])
+
+        topology.declare(self.channel)
+
+        self.channel.exchange_declare.assert_called_once_with(
+            exchange='swift', exchange_type='topic', durable=True)
+        self.channel.queue_bind.assert_called_once_with(
+            queue='a', exchange='swift', routing_key='a')
+
+    def test_queue_arguments_are_merged(self):
+        conf = {'queue_mode': 'lazy'}
+        topology = tp.Topology(conf, [('a', {'x-max-priority': 9})])
+
+        topology.declare(self.channel)
+
+        self.channel.queue_declare.assert_called_once_with(
+            queue='a', durable=True,
+            arguments={'x-queue-mode': 'lazy', 'x-max-priority': 9})
+
+    def test_declaration_is_cached(self):
+        topology = tp.Topology({}, [('a', None)])
+
+        topology.declare(self.channel)
+        topology.declare(Mock())
+
+        self.channel.queue_declare.assert_called_once()
+
+    def test_failed_declaration_is_not_cached(self):
+        topology = tp.Topology({}, [('a', None)])
+        self.channel.queue_declare.side_effect = Exception
+
+        with self.assertRaises(Exception):
+            topology.declare(self.channel)
+
+        self.assertFalse(topology.declared)
+
+    def test_channel_closed_invalidates_cache(self):
+        topology = tp.Topology({}, [('a', None)])
+        topology.declare(self.channel)
+
+        topology.on_publish_error(pika.exceptions.ConnectionClosed())
+        self.assertTrue(topology.declared)
+
+        topology.on_publish_error(pika.exceptions.ChannelClosed())
+        self.assertFalse(topology.declared)
@@ -0,0 +1,111 @@
+"""
+Broker topology for the ``metadata_enqueue`` middleware.
+
+By default, queues are declared durable, without arguments, and messages
+are published through the default exchange. The filter section may set:
+
+    # Publish through a named exchange; queues are bound to it using their
+    # own name as routing key
+    exchange = swift_metadata
+    exchange_type = direct
+
+    # Queue arguments. Lazy queues keep messages on disk and, along with a
+    # length limit, keep broker memory bounded while consumers are away.
+    queue_mode = lazy
+    queue_max_length = 1000000
+    queue_max_length_bytes
+    queue_overflow = reject-publish-dlx
+    queue_message_ttl = 86400000
+    queue_dead_letter_exchange = swift_metadata_dlx
+    queue_dead_letter_routing_key
+
+RabbitMQ refuses to redeclare a queue with different arguments, so changing
+them for an existing queue requires deleting it first (or using a policy).
+"""
+import pika
+
+QUEUE_OVERFLOWS = ('drop-head', 'reject-publish', 'reject-publish-dlx')
+
+# Configuration key: (queue argument, type)
+QUEUE_ARGUMENTS = (
+    ('queue_mode', 'x-queue-mode', str),
+    ('queue_max_length', 'x-max-length', int),
+    ('queue_max_length_bytes', 'x-max-length-bytes', int),
+    ('queue_overflow', 'x-overflow', str),
+    ('queue_message_ttl', 'x-message-ttl', int),
+    ('queue_dead_letter_exchange', 'x-dead-letter-exchange', str),
+    ('queue_dead_letter_routing_key', 'x-dead-letter-routing-key', str),
+)
+
+
+def queue_arguments(conf):
+    """
+    Returns the queue arguments set in ``conf``.
+
+    :raises ValueError: if a value is invalid
+    """
+    arguments = {}
+    for key, argument, cast in QUEUE_ARGUMENTS:
+        if conf.get(key):
+            arguments[argument] = cast(conf[key])
+
+    overflow = arguments.get('x-overflow')
+    if overflow and overflow not in QUEUE_OVERFLOWS:
+        raise ValueError('Invalid queue_overflow: %s' % overflow)
+
+    return arguments
+
+
+class Topology(object):
+    """
+    Declares the exchange and queues used by the middleware.
+
+    Declaration is idempotent and runs once per process: reconnecting does
+    not declare everything again. ``invalidate`` forces a new declaration on
+    the next connection, e.g. after the broker closed a channel because an
+    exchange or queue was missing.
+
+    :param conf: filter configuration
+    :param queues: list of ``(queue, arguments)``; arguments are merged
+                   over the ones set in ``conf``
+    """
+
+    def __init__(self, conf, queues):
+        self.exchange = conf.get('exchange', '')
+        self.exchange_type = conf.get('exchange_type', 'direct')
+        self.queues = queues
+        self.arguments = queue_arguments(conf)
+
+        self.declared = False
+
+    def declare(self, channel):
+        if self.declared:
+            return
+
+        if self.exchange:
+            channel.exchange_declare(exchange=self.exchange,
+                                     exchange_type=self.exchange_type,
+                                     durable=True)
+
+        for queue, extra in self.queues:
+            arguments = dict(self.arguments)
+            arguments.update(extra or {})
+            if arguments:
+                channel.queue_declare(queue=queue, durable=True,
+                                      arguments=arguments)
+            else:
+                channel.queue_declare(queue=queue, durable=True)
+
+            if self.exchange:
+                channel.queue_bind(queue=queue, exchange=self.exchange,
+                                   routing_key=queue)
+
+        self.declared = True
+
+    def invalidate(self):
+        self.declared = False
+
+    def on_publish_error(self, error):
+        """ Redeclare if the broker closed the channel (e.g. 404) """
+        if isinstance(error, pika.exceptions.ChannelClosed):
+            self.invalidate()